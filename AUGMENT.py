@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import scipy.io
+from PIL import Image
+from DATA import PatchStore, STORE_INPUT, STORE_GT, STORE_INDEX
+
+SOURCES_FILE = 'sources.json'
+TEST_CROP = (slice(33, 289), slice(33, 289))  # img(34:289,34:289) in aug_test.m
+
+
+def find_sources(src_dir):
+    """
+    Lists the (input, ground truth) image pairs of a source directory. Every
+    X_mask.tif is the ground truth of X.tif.
+    """
+    pairs = []
+    for mask_path in sorted(glob.glob(os.path.join(src_dir,
+                            '*_mask.tif'))):
+        input_path = mask_path[:-len('_mask.tif')] + '.tif'
+        if os.path.exists(input_path):
+            pairs.append((input_path, mask_path))
+    return pairs
+
+
+def read_image(path):
+    """
+    Reads the first channel of an image scaled to [0, 1] like im2double.
+    """
+    img = np.asarray(Image.open(path))
+    if img.ndim == 3:
+        img = img[:, :, 0]
+    if np.issubdtype(img.dtype, np.integer):
+        return img / np.iinfo(img.dtype).max
+    return img.astype(np.float64)
+
+
+def crop_to_multiple(img, multiple=12):
+    (height, width) = img.shape[:2]
+    return img[:height - height % multiple, :width - width % multiple]
+
+
+def patch_positions(shape, patch_size, stride):
+    """
+    Top left corners of the patches in the order aug_train.m writes them,
+    columns in the outer loop.
+    """
+    (height, width) = shape[:2]
+    return [(y, x) for x in range(0, width - patch_size + 1, stride)
+            for y in range(0, height - patch_size + 1, stride)]
+
+
+def cut_train_patches(
+    img_raw,
+    img_2,
+    patch_size=256,
+    stride=60,
+    ):
+    """
+    Cuts the four orientations aug_train.m writes for every position: as is,
+    rotated by 90 degrees, flipped left-right, and rotated then flipped.
+
+    :returns gt, input: arrays of shape [n, patch_size, patch_size]
+    """
+    (gt, inputs) = ([], [])
+    for (y, x) in patch_positions(img_raw.shape, patch_size, stride):
+        for (img, out) in ((img_raw, gt), (img_2, inputs)):
+            patch = img[y:y + patch_size, x:x + patch_size]
+            out.extend([patch, np.rot90(patch), np.fliplr(patch),
+                       np.fliplr(np.rot90(patch))])
+    return (np.array(gt), np.array(inputs))
+
+
+def count_patches(
+    mode,
+    input_path,
+    patch_size,
+    stride,
+    ):
+    """
+    Number of patches a source yields, read from the image header only.
+    """
+    if mode == 'test':
+        return 1
+    (width, height) = Image.open(input_path).size
+    shape = (height - height % 12, width - width % 12)
+    return 4 * len(patch_positions(shape, patch_size, stride))
+
+
+def write_mat(
+    mat_dir,
+    first,
+    gt,
+    inputs,
+    mode,
+    ):
+    (gt_key, input_key) = (('patch', 'patch') if mode == 'train'
+                            else ('img_raw', 'img_2'))
+    for (i, (gt_img, input_img)) in enumerate(zip(gt, inputs)):
+        name = os.path.join(mat_dir, '%d' % (first + i))
+        scipy.io.savemat(name + '.mat', {gt_key: gt_img})
+        scipy.io.savemat(name + '_2.mat', {input_key: input_img})
+
+
+def build_source(job):
+    """
+    Cuts one source pair. Runs in the worker processes.
+
+    :param job: (mode, input_path, mask_path, patch_size, stride, mat_dir, first)
+
+    :returns gt, input: float32 arrays, or the number of patches written
+        to mat_dir
+    """
+    (
+        mode,
+        input_path,
+        mask_path,
+        patch_size,
+        stride,
+        mat_dir,
+        first,
+        ) = job
+    img_2 = crop_to_multiple(read_image(input_path))
+    img_raw = crop_to_multiple(read_image(mask_path))
+    if mode == 'train':
+        (gt, inputs) = cut_train_patches(img_raw, img_2, patch_size,
+                stride)
+    else:
+        if min(img_raw.shape[:2]) < TEST_CROP[0].stop:
+            raise ValueError('%s is smaller than the %dx%d test crop'
+                             % (mask_path, TEST_CROP[0].stop,
+                             TEST_CROP[1].stop))
+        (gt, inputs) = (img_raw[TEST_CROP][np.newaxis],
+                        img_2[TEST_CROP][np.newaxis])
+    if mat_dir is not None:
+        write_mat(mat_dir, first, gt, inputs, mode)
+        return len(gt)
+    return (gt.astype(np.float32), inputs.astype(np.float32))
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda : f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """
+    mtime, size and sha1 of a file. The hash is only recomputed when mtime or
+    size differ from `previous`.
+    """
+    record = {'mtime': os.path.getmtime(path),
+              'size': os.path.getsize(path)}
+    if previous is not None and previous['mtime'] == record['mtime'] \
+            and previous['size'] == record['size']:
+        record['sha1'] = previous['sha1']
+    else:
+        record['sha1'] = file_sha1(path)
+    return record
+
+
+def load_build_state(out_dir, layout):
+    """
+    Reads what the previous build recorded about its sources, or None.
+    """
+    path = os.path.join(out_dir, (STORE_INDEX if layout == 'packed'
+                         else SOURCES_FILE))
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_dataset(
+    src_dir,
+    out_dir,
+    mode='train',
+    layout='packed',
+    patch_size=256,
+    stride=60,
+    processes=None,
+    ):
+    """
+    Builds the train patches (aug_train.m) or test slices (aug_test.m) of a
+    directory of *.tif / *_mask.tif pairs on a process pool. Sources whose
+    content did not change since the last build into out_dir are not
+    decoded again.
+
+    :param src_dir: directory of X.tif / X_mask.tif pairs
+    :param out_dir: output directory
+    :param mode: 'train' or 'test'
+    :param layout: 'packed' writes a DATA.PatchStore, 'mat' writes the
+        N.mat / N_2.mat files of the MATLAB scripts
+    :param patch_size: side of the train patches
+    :param stride: stride between train patches
+    :param processes: pool size, defaults to the number of cores
+
+    :returns count, rebuilt: number of patches and of rebuilt sources
+    """
+    params = {
+        'mode': mode,
+        'layout': layout,
+        'patch_size': patch_size,
+        'stride': stride,
+        }
+    previous = load_build_state(out_dir, layout)
+    if previous is None or previous.get('params') != params:
+        previous = {'sources': []}
+    old = dict((record['name'], record) for record in
+               previous['sources'])
+
+    records = []
+    jobs = []
+    first = 0
+    mat_dir = (out_dir if layout == 'mat' else None)
+    for (input_path, mask_path) in find_sources(src_dir):
+        name = os.path.basename(input_path)
+        prev = old.get(name)
+        record = {'name': name, 'first': first,
+                  'input': fingerprint(input_path, prev and prev['input'
+                  ]), 'mask': fingerprint(mask_path, prev
+                  and prev['mask'])}
+        unchanged = prev is not None and prev['input']['sha1'] \
+            == record['input']['sha1'] and prev['mask']['sha1'] \
+            == record['mask']['sha1']
+        if unchanged:
+            record['count'] = prev['count']
+        else:
+            record['count'] = count_patches(mode, input_path,
+                    patch_size, stride)
+
+        # packed sources are copied from the previous store, mat files can
+        # only be kept if their numbering did not move
+
+        if unchanged and (layout == 'packed' or prev['first'] == first):
+            record['reuse'] = prev['first']
+        else:
+            jobs.append((len(records), (
+                mode,
+                input_path,
+                mask_path,
+                patch_size,
+                stride,
+                mat_dir,
+                first,
+                )))
+        records.append(record)
+        first += record['count']
+    count = first
+    if count == 0:
+        raise ValueError('No *.tif / *_mask.tif pairs found in %s'
+                         % src_dir)
+
+    if layout == 'mat' and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(build_source, [job for (_, job) in jobs])
+        if layout == 'mat':
+            for ((i, _), written) in zip(jobs, results):
+                if written != records[i]['count']:
+                    raise ValueError('%s yielded %d patches, expected %d'
+                            % (records[i]['name'], written,
+                            records[i]['count']))
+            for path in glob.glob(os.path.join(out_dir, '*.mat')):
+
+                # drop patches left over from a larger previous build
+
+                number = os.path.basename(path)[:-4].split('_')[0]
+                if number.isdigit() and int(number) >= count:
+                    os.remove(path)
+            state_dir = out_dir
+        else:
+            size = (patch_size if mode == 'train' else TEST_CROP[0].stop
+                    - TEST_CROP[0].start)
+            shape = (count, size, size, 1)
+            state_dir = out_dir.rstrip('/') + '.tmp'
+            shutil.rmtree(state_dir, ignore_errors=True)
+            os.makedirs(state_dir)
+            gt = np.lib.format.open_memmap(os.path.join(state_dir,
+                    STORE_GT), mode='w+', dtype=np.float32, shape=shape)
+            inputs = np.lib.format.open_memmap(os.path.join(state_dir,
+                    STORE_INPUT), mode='w+', dtype=np.float32,
+                    shape=shape)
+            if len(jobs) < len(records):
+                old_store = PatchStore(out_dir)
+                for record in records:
+                    if 'reuse' in record:
+                        src = slice(record['reuse'], record['reuse']
+                                    + record['count'])
+                        dst = slice(record['first'], record['first']
+                                    + record['count'])
+                        gt[dst] = old_store.gt[src]
+                        inputs[dst] = old_store.inputs[src]
+                del old_store
+            for ((i, _), (gt_patches, input_patches)) in zip(jobs,
+                    results):
+                record = records[i]
+                if len(gt_patches) != record['count']:
+                    raise ValueError('%s yielded %d patches, expected %d'
+                            % (record['name'], len(gt_patches),
+                            record['count']))
+                dst = slice(record['first'], record['first']
+                            + record['count'])
+                gt[dst, :, :, 0] = gt_patches
+                inputs[dst, :, :, 0] = input_patches
+            gt.flush()
+            inputs.flush()
+            del gt, inputs
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for record in records:
+        record.pop('reuse', None)
+    state = {
+        'count': count,
+        'shape': ([size, size, 1] if layout == 'packed' else None),
+        'dtype': 'float32',
+        'source': os.path.abspath(src_dir),
+        'params': params,
+        'sources': records,
+        }
+    with open(os.path.join(state_dir, (STORE_INDEX if layout
+              == 'packed' else SOURCES_FILE)), 'w') as f:
+        json.dump(state, f)
+    if layout == 'packed':
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.rename(state_dir, out_dir)
+    return (count, len(jobs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build train patches or test slices from *.tif / *_mask.tif pairs (replaces data/aug_train.m and data/aug_test.m).')
+    parser.add_argument('mode', choices=['train', 'test'])
+    parser.add_argument('src_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--layout', choices=['packed', 'mat'],
+                        default='packed')
+    parser.add_argument('--patch_size', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=60)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+    (count, rebuilt) = build_dataset(
+        args.src_dir,
+        args.out_dir,
+        args.mode,
+        args.layout,
+        args.patch_size,
+        args.stride,
+        args.processes,
+        )
+    print('%d patches in %s, %d sources rebuilt' % (count,
+          args.out_dir, rebuilt))
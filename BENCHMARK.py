@@ -0,0 +1,535 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import platform
+import subprocess
+import multiprocessing
+from functools import partial
+import numpy as np
+import tensorflow as tf
+from MODEL import model, unet, batch_norm_bias_relu, restore_unet
+from MODEL_FACTORIZED import model_factorized
+from DATA import EvalSet
+from EVAL import running_means
+from PSNR import psnr
+from SESSION import add_session_args, make_session, model_device, \
+    session_args
+
+MODELS = {
+    'vdsr': model,
+    'unet': partial(unet, is_training=True),
+    'unet_fused': partial(unet, is_training=True, fused_bn=True),
+    'factorized': model_factorized,
+    }
+
+# the precision benchmark runs the networks as TEST.py does: the U-Net batch
+# norms use their population statistics, and the checkpoints load by name
+
+INFERENCE_MODELS = dict(MODELS, unet=partial(unet, is_training=False),
+                        unet_fused=partial(unet, is_training=False,
+                        fused_bn=True))
+RESTORE_FNS = {'unet': restore_unet, 'unet_fused': restore_unet}
+
+
+def time_steps(
+    sess,
+    fetches,
+    feed_dict,
+    steps,
+    warmup=5,
+    ):
+    """
+    Runs `steps` timed steps after `warmup` untimed ones.
+
+    :returns steps_per_sec: measured rate
+    """
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+    start = time.time()
+    for _ in range(steps):
+        sess.run(fetches, feed_dict=feed_dict)
+    return steps / (time.time() - start)
+
+
+def step_latencies(
+    sess,
+    fetches,
+    feed_dict,
+    steps,
+    warmup=5,
+    ):
+    """
+    Like time_steps, but times every step on its own.
+
+    :returns latencies: seconds of each timed step
+    """
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+    latencies = np.empty(steps)
+    for i in range(steps):
+        start = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        latencies[i] = time.time() - start
+    return latencies
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+
+    return peak / (2.0 ** 20 if sys.platform == 'darwin' else 2.0 ** 10)
+
+
+def benchmark_case(
+    build_fn,
+    batch_size,
+    img_size,
+    steps=20,
+    warmup=3,
+    session_kwargs={},
+    ):
+    """
+    Times the forward pass and the Adam training step of one network on one
+    synthetic batch shape.
+
+    :param build_fn: callable building the network on an input tensor and
+        returning (output, weights)
+    :param session_kwargs: passed to SESSION.make_session
+
+    :returns results: {'forward': stats, 'train': stats}, where stats holds
+        images_per_sec, latency_ms {mean, p50, p95, p99} and the peak RSS
+        of the process after that phase
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        shape = (batch_size, img_size, img_size, 1)
+        x = tf.placeholder(tf.float32, shape=shape)
+        gt = tf.placeholder(tf.float32, shape=shape)
+        with tf.variable_scope('foo'):
+            (output, _) = build_fn(x)
+        loss = tf.reduce_mean(tf.nn.l2_loss(output - gt))
+        opt = tf.train.AdamOptimizer(0.0001).minimize(loss)
+        init = tf.global_variables_initializer()
+
+    rng = np.random.RandomState(0)
+    feed_dict = {x: rng.rand(*shape).astype(np.float32),
+                 gt: rng.rand(*shape).astype(np.float32)}
+    results = {}
+    with make_session(graph, **session_kwargs) as sess:
+        sess.run(init)
+        for (phase, fetches) in (('forward', output), ('train', opt)):
+            latencies = step_latencies(sess, fetches, feed_dict, steps,
+                    warmup)
+            stats = {'images_per_sec': batch_size * steps
+                     / latencies.sum(),
+                     'latency_ms': {'mean': 1e3 * latencies.mean()},
+                     'peak_rss_mb': peak_rss_mb()}
+            for q in (50, 95, 99):
+                stats['latency_ms']['p%d' % q] = 1e3 \
+                    * float(np.percentile(latencies, q))
+            results[phase] = stats
+    return results
+
+
+def run_suite(
+    models,
+    batch_sizes,
+    img_sizes,
+    steps=20,
+    session_argv=(),
+    ):
+    """
+    Runs benchmark_case for every model, image size and batch size, each in
+    a process of its own so the peak RSS belongs to that case alone and an
+    out-of-memory case does not end the suite.
+
+    :param session_argv: SESSION flags passed on to every case
+
+    :returns report: JSON-serialisable dict of the environment and results
+    """
+    report = {
+        'time': time.time(),
+        'host': platform.node(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'tensorflow': tf.__version__,
+        'numpy': np.__version__,
+        'session_args': list(session_argv),
+        'results': [],
+        }
+    for name in models:
+        for img_size in img_sizes:
+            for batch_size in batch_sizes:
+                argv = [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    'case',
+                    '--model',
+                    name,
+                    '--batch_size',
+                    str(batch_size),
+                    '--img_size',
+                    str(img_size),
+                    '--steps',
+                    str(steps),
+                    ] + list(session_argv)
+                proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
+                (out, err) = proc.communicate()
+                result = {'model': name, 'batch_size': batch_size,
+                          'img_size': img_size}
+                if proc.returncode:
+                    lines = err.decode('utf-8', 'replace').strip().splitlines()
+                    result['error'] = (lines[-1] if lines else 'exit status %d'
+                             % proc.returncode)
+                else:
+                    result.update(json.loads(out.decode('utf-8'
+                                  ).strip().splitlines()[-1]))
+                report['results'].append(result)
+                print(format_result(result))
+    return report
+
+
+def format_result(result):
+    line = '%-10s img %4d batch %2d' % (result['model'],
+            result['img_size'], result['batch_size'])
+    if 'error' in result:
+        return line + '  failed: ' + result['error']
+    for phase in ('forward', 'train'):
+        stats = result[phase]
+        line += '  %s %8.2f img/s p50 %8.1fms p99 %8.1fms' % (phase,
+                stats['images_per_sec'], stats['latency_ms']['p50'],
+                stats['latency_ms']['p99'])
+    return line + '  peak RSS %.0fMB' % result['train']['peak_rss_mb']
+
+
+def compare_reports(old, new):
+    """
+    Prints the images/sec change of every case present in both reports.
+    """
+    key = lambda result: (result['model'], result['img_size'],
+                          result['batch_size'])
+    before = dict((key(result), result) for result in old['results']
+                  if 'error' not in result)
+    for result in new['results']:
+        if 'error' in result or key(result) not in before:
+            continue
+        line = '%-10s img %4d batch %2d' % key(result)
+        for phase in ('forward', 'train'):
+            line += '  %s %+6.1f%%' % (phase, 100 * (result[phase
+                    ]['images_per_sec'] / before[key(result)][phase
+                    ]['images_per_sec'] - 1))
+        print(line)
+
+
+def benchmark_fetches(
+    build_fn,
+    batch_size=4,
+    img_size=256,
+    steps=50,
+    warmup=5,
+    session_kwargs={},
+    ):
+    """
+    Compares the training step rate when every step copies train_output, loss,
+    acc and the learning rate back to the host, as the training files used to,
+    against fetching only the optimizer and the on-device running means.
+
+    :param build_fn: callable building the network on an input tensor and
+        returning (output, weights)
+    :param session_kwargs: passed to SESSION.make_session
+
+    :returns results: {'full': steps/sec, 'scalars': steps/sec}
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        shape = (batch_size, img_size, img_size, 1)
+        train_input = tf.placeholder(tf.float32, shape=shape)
+        train_gt = tf.placeholder(tf.float32, shape=shape)
+        with tf.variable_scope('foo'):
+            (train_output, _) = build_fn(train_input)
+        loss = tf.reduce_mean(tf.nn.l2_loss(train_output - train_gt))
+        acc = tf.reduce_mean(tf.cast(tf.equal(train_output, train_gt),
+                             tf.float32))
+        (_, update_means, reset_means) = running_means([loss, acc])
+        global_step = tf.Variable(0, trainable=False)
+        learning_rate = tf.Variable(0.0001)
+        opt = tf.train.AdamOptimizer(learning_rate).minimize(loss,
+                global_step=global_step)
+        init = tf.global_variables_initializer()
+
+    rng = np.random.RandomState(0)
+    feed_dict = {train_input: rng.rand(*shape).astype(np.float32),
+                 train_gt: rng.rand(*shape).astype(np.float32)}
+    with make_session(graph, **session_kwargs) as sess:
+        sess.run([init, reset_means])
+        full = [
+            opt,
+            loss,
+            acc,
+            train_output,
+            learning_rate,
+            global_step,
+            ]
+        return {'full': time_steps(sess, full, feed_dict, steps, warmup),
+                'scalars': time_steps(sess, [opt, update_means,
+                global_step], feed_dict, steps, warmup)}
+
+
+def benchmark_precision(
+    build_fn,
+    eval_set,
+    dtypes=('float32', 'float16'),
+    model_path=None,
+    residual=False,
+    steps=10,
+    warmup=2,
+    session_kwargs={},
+    restore_fn=None,
+    ):
+    """
+    Runs the same float32 weights with the activations in each dtype over an
+    evaluation set and reports speed and PSNR.
+
+    :param build_fn: callable building the network on an input tensor and
+        returning (output, weights). It must take a dtype argument
+    :param eval_set: DATA.EvalSet
+    :param dtypes: compute dtypes to compare, the first is the reference
+    :param model_path: checkpoint of the weights, random weights if None
+    :param residual: the network predicts gt - input
+    :param session_kwargs: passed to SESSION.make_session
+    :param restore_fn: callable(sess, model_path, weights) loading the
+        checkpoint, e.g. MODEL.restore_unet. A tf.train.Saver of the weights
+        if None
+
+    :returns results: list of {'dtype', 'images_per_sec', 'psnr'}
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        test_input = tf.placeholder(tf.float32, shape=(None, None, None,
+                                    1))
+        outputs = []
+        for (i, dtype) in enumerate(dtypes):
+
+            # every tower reads the same float32 variables
+
+            with tf.variable_scope('foo', reuse=i > 0):
+                (output, tower_weights) = build_fn(test_input,
+                        dtype=dtype)
+            outputs.append((output + test_input if residual else output))
+            if i == 0:
+                weights = tower_weights
+        if restore_fn is None:
+            saver = tf.train.Saver(weights)
+            restore_fn = lambda sess, path, weights: saver.restore(sess,
+                    path)
+        init = tf.global_variables_initializer()
+
+    results = []
+    with make_session(graph, **session_kwargs) as sess:
+        sess.run(init)
+        if model_path:
+            restore_fn(sess, model_path, weights)
+        for (dtype, output) in zip(dtypes, outputs):
+
+            # one batch per slice size of the set
+
+            seconds = 0.0
+            (predictions, gt) = ([], [])
+            for (inputs, group_gt) in eval_set.groups:
+                feed_dict = {test_input: inputs}
+                seconds += 1.0 / time_steps(sess, output, feed_dict,
+                        steps, warmup)
+                predictions.append(sess.run(output,
+                                   feed_dict=feed_dict).ravel())
+                gt.append(group_gt.ravel())
+            results.append({'dtype': dtype, 'images_per_sec': len(eval_set)
+                           / seconds, 'psnr': psnr(np.concatenate(predictions),
+                           np.concatenate(gt), 0)})
+    return results
+
+
+def benchmark_batch_norm(
+    batch_size=4,
+    img_size=256,
+    layers=3,
+    features_root=64,
+    steps=50,
+    warmup=5,
+    device='/gpu:0',
+    session_kwargs={},
+    ):
+    """
+    Times the batch norm, bias and ReLU after every U-Net convolution,
+    forward and backward, with MODEL.batch_norm_wrapper and with the fused
+    kernel, and then the training step of the whole network both ways.
+
+    :returns results: list of {'layer', 'shape', 'unfused', 'fused'} in
+        steps/sec, the last one for the whole network
+    """
+    shapes = []
+    for layer in range(layers):
+        shape = (batch_size, img_size // 2 ** layer, img_size // 2
+                 ** layer, 2 ** layer * features_root)
+        shapes += [('down_%d_%d' % (layer, i), shape) for i in (1, 2)]
+    for layer in range(layers - 2, -1, -1):
+        shape = (batch_size, img_size // 2 ** layer, img_size // 2
+                 ** layer, 2 ** layer * features_root)
+        shapes += [('up_%d_%d' % (layer, i), shape) for i in (1, 2)]
+
+    results = []
+    for (name, shape) in shapes:
+        result = {'layer': name, 'shape': shape}
+        for fused in (False, True):
+            graph = tf.Graph()
+            with graph.as_default(), tf.device(device):
+                inputs = tf.Variable(tf.random_normal(shape))
+                (_, outputs, _) = batch_norm_bias_relu(inputs, 'b',
+                        True, fused=fused)
+                grads = tf.gradients(tf.reduce_sum(outputs),
+                        tf.trainable_variables())
+                init = tf.global_variables_initializer()
+            with make_session(graph, **session_kwargs) as sess:
+                sess.run(init)
+                result[('fused' if fused else 'unfused')] = \
+                    time_steps(sess, grads, {}, steps, warmup)
+        results.append(result)
+
+    shape = (batch_size, img_size, img_size, 1)
+    result = {'layer': 'unet', 'shape': shape}
+    rng = np.random.RandomState(0)
+    for fused in (False, True):
+        graph = tf.Graph()
+        with graph.as_default():
+            train_input = tf.placeholder(tf.float32, shape=shape)
+            (output, _) = unet(train_input, True, layers=layers,
+                               features_root=features_root,
+                               device=device, fused_bn=fused)
+            opt = tf.train.AdamOptimizer(0.0001).minimize(
+                tf.reduce_mean(tf.nn.l2_loss(output - train_input)))
+            init = tf.global_variables_initializer()
+        with make_session(graph, **session_kwargs) as sess:
+            sess.run(init)
+            result[('fused' if fused else 'unfused')] = time_steps(sess,
+                    opt, {train_input: rng.rand(*shape)}, steps, warmup)
+    results.append(result)
+    return results
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training and inference benchmarks.')
+    parser.add_argument('benchmark', choices=[
+        'fetch',
+        'precision',
+        'suite',
+        'case',
+        'compare',
+        'batch_norm',
+        ])
+    parser.add_argument('--model', choices=sorted(MODELS), default='vdsr')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--data_path',
+                        default='./data/bp_ang90_snr20_test/',
+                        help='test slices of the precision benchmark')
+    parser.add_argument('--eval_count', type=int, default=10)
+    parser.add_argument('--model_path')
+    parser.add_argument('--residual', action='store_true')
+    parser.add_argument('--dtypes', default='float32,float16')
+    parser.add_argument('--layers', type=int, default=3,
+                        help='batch_norm: U-Net depth')
+    parser.add_argument('--features_root', type=int, default=64,
+                        help='batch_norm: U-Net features of the first layer')
+    parser.add_argument('--models', default='vdsr,unet,factorized',
+                        help='suite: networks to build')
+    parser.add_argument('--batch_sizes', type=int_list,
+                        default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--img_sizes', type=int_list, default=[64, 256,
+                        512, 1024])
+    parser.add_argument('--output', default='benchmark.json',
+                        help='suite: JSON report to write')
+    parser.add_argument('reports', nargs='*',
+                        help='compare: old and new JSON report')
+    add_session_args(parser)
+    args = parser.parse_args()
+    build_fn = partial(MODELS[args.model], device=model_device(args.cpu))
+
+    if args.benchmark == 'suite':
+        session_argv = ['--cpu'] if args.cpu else []
+        for flag in ('intra_op_threads', 'inter_op_threads'):
+            session_argv += ['--' + flag, str(getattr(args, flag))]
+        if args.cpus:
+            session_argv += ['--cpus', ','.join(str(cpu) for cpu in
+                             args.cpus)]
+        report = run_suite(args.models.split(','), args.batch_sizes,
+                           args.img_sizes, args.steps, session_argv)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print('wrote', args.output)
+    elif args.benchmark == 'case':
+        print(json.dumps(benchmark_case(build_fn, args.batch_size,
+              args.img_size, args.steps,
+              session_kwargs=session_args(args))))
+    elif args.benchmark == 'compare':
+        (old, new) = [json.load(open(path)) for path in args.reports]
+        compare_reports(old, new)
+    elif args.benchmark == 'batch_norm':
+        results = benchmark_batch_norm(
+            args.batch_size,
+            args.img_size,
+            args.layers,
+            args.features_root,
+            args.steps,
+            device=model_device(args.cpu),
+            session_kwargs=session_args(args),
+            )
+        for result in results:
+            print('%-8s %-22s unfused %8.2f steps/sec  fused %8.2f steps/sec (x%.2f)'
+                   % (result['layer'], result['shape'], result['unfused'
+                  ], result['fused'], result['fused'] / result['unfused'
+                  ]))
+    elif args.benchmark == 'fetch':
+        results = benchmark_fetches(build_fn, args.batch_size,
+                                    args.img_size, args.steps,
+                                    session_kwargs=session_args(args))
+        print('fetch train_output every step: %.2f steps/sec'
+              % results['full'])
+        print('fetch scalars only: %.2f steps/sec (%+.1f%%)'
+              % (results['scalars'], 100 * (results['scalars']
+              / results['full'] - 1)))
+    else:
+        eval_set = EvalSet.open(args.data_path, args.eval_count)
+        results = benchmark_precision(
+            partial(INFERENCE_MODELS[args.model],
+                    device=model_device(args.cpu)),
+            eval_set,
+            args.dtypes.split(','),
+            args.model_path,
+            args.residual,
+            args.steps,
+            session_kwargs=session_args(args),
+            restore_fn=RESTORE_FNS.get(args.model),
+            )
+        reference = results[0]
+        print('input PSNR %f' % eval_set.baseline_psnr)
+        for result in results:
+            print('%-8s %8.2f images/sec (x%.2f)\t PSNR %f (%+.4f dB)'
+                  % (result['dtype'], result['images_per_sec'],
+                  result['images_per_sec'] / reference['images_per_sec'],
+                  result['psnr'], result['psnr'] - reference['psnr']))
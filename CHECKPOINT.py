@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import glob
+import json
+import threading
+import tensorflow as tf
+from SESSION import make_session
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def checkpoint_files(prefix):
+    """
+    Files of a V2 checkpoint: prefix.index, prefix.data-* and the optional
+    prefix.json sidecar.
+    """
+    return glob.glob(prefix + '.index') + glob.glob(prefix + '.data-*') \
+        + glob.glob(prefix + '.json')
+
+
+def atomic_write_json(path, obj):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.rename(tmp_path, path)
+
+
+def training_state_path(ckpt_path):
+    """
+    Prefix of the training state checkpoints that belong to ckpt_path. They
+    live in a directory of their own, next to the weight checkpoints.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(ckpt_path)),
+                        'state', os.path.basename(ckpt_path))
+
+
+def load_training_state(state_path):
+    """
+    Sidecar of the newest training state written under state_path by a
+    CheckpointWriter, with the checkpoint prefix added as 'path', or None if
+    there is none. Only this JSON file is read, so it costs the same for
+    every dataset size.
+    """
+    history_path = state_path + '.json'
+    if not os.path.exists(history_path):
+        return None
+    with open(history_path) as f:
+        prefix = json.load(f)['latest']
+    with open(prefix + '.json') as f:
+        state = json.load(f)
+    state['path'] = prefix
+    return state
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread. `submit` only copies the
+    variables out of the training session; a shadow graph holding the same
+    variables is saved on the worker thread while training continues.
+
+    Every checkpoint is written under a temporary prefix and renamed to
+    `ckpt_path-<step>` once complete, index file last, so a crash during a
+    write never leaves a readable but corrupt checkpoint. The newest one is
+    also linked to `ckpt_path` itself, where the training files saved before.
+    The history in `ckpt_path.json` and the state file
+    `ckpt_path.checkpoint`, read by tf.train.latest_checkpoint(save_dir,
+    latest_filename), are replaced atomically as well; they are named after
+    ckpt_path so trainers sharing a directory keep their own. The last
+    `keep` checkpoints and the `keep_best` ones with the highest PSNR are
+    kept, the others are deleted.
+
+    The checkpoints hold the variables under their training graph names, so
+    a tf.train.Saver over the same variables restores them.
+
+    :param variables: variables to save, e.g. the weights of MODEL.model
+    :param ckpt_path: checkpoint prefix, the step number is appended
+    :param keep: most recent checkpoints to keep
+    :param keep_best: checkpoints with the highest PSNR to keep
+    """
+
+    def __init__(
+        self,
+        variables,
+        ckpt_path,
+        keep=5,
+        keep_best=1,
+        ):
+        self.variables = list(variables)
+        self.ckpt_path = os.path.abspath(ckpt_path)
+        self.save_dir = os.path.dirname(self.ckpt_path)
+        self.history_path = self.ckpt_path + '.json'
+        self.latest_filename = os.path.basename(self.ckpt_path) \
+            + '.checkpoint'
+        self.keep = keep
+        self.keep_best = keep_best
+        self.error = None
+        if not os.path.exists(self.save_dir):
+            os.makedirs(self.save_dir)
+
+        # continue the history of an earlier run with the same ckpt_path
+
+        self.history = []
+        if os.path.exists(self.history_path):
+            with open(self.history_path) as f:
+                self.history = json.load(f)['checkpoints']
+
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.shadows = [tf.Variable(tf.zeros(var.get_shape(),
+                            var.dtype.base_dtype), trainable=False,
+                            name='shadow_%d' % i) for (i, var) in
+                            enumerate(self.variables)]
+            self.saver = tf.train.Saver(dict((var.op.name, shadow)
+                    for (var, shadow) in zip(self.variables,
+                    self.shadows)), max_to_keep=None)
+            init = tf.global_variables_initializer()
+        self.sess = make_session(self.graph, cpu_only=True)
+        self.sess.run(init)
+
+        # one snapshot may wait while another is written, a third blocks
+        # the training thread instead of being dropped
+
+        self.pending = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def best(self):
+        """
+        History entry {'path', 'step', 'psnr'} of the best checkpoint so far,
+        or None.
+        """
+        scored = [entry for entry in self.history if entry['psnr']
+                  is not None]
+        if not scored:
+            return None
+        return max(scored, key=lambda entry: entry['psnr'])
+
+    def submit(
+        self,
+        sess,
+        step,
+        psnr=None,
+        extra=None,
+        ):
+        """
+        Snapshots the variables of sess for writing.
+
+        :param step: global step, names the checkpoint
+        :param psnr: test PSNR of the snapshot, ranks the best checkpoints
+        :param extra: optional JSON-serialisable dict written next to the
+            checkpoint as prefix.json, before the checkpoint is complete
+        """
+        if self.error is not None:
+            raise self.error
+        values = sess.run(self.variables)
+        self.pending.put((int(step), (None if psnr is None else float(psnr)),
+                         values, extra))
+
+    def _run(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                return
+            try:
+                self._write(*job)
+            except Exception as e:
+                self.error = e
+
+    def _write(
+        self,
+        step,
+        psnr,
+        values,
+        extra,
+        ):
+        for (shadow, value) in zip(self.shadows, values):
+            shadow.load(value, self.sess)
+        prefix = '%s-%d' % (self.ckpt_path, step)
+        tmp_prefix = prefix + '.tmp'
+        self.saver.save(self.sess, tmp_prefix, write_meta_graph=False,
+                        write_state=False)
+        data_files = [path for path in checkpoint_files(tmp_prefix)
+                      if not path.endswith('.index')]
+        for path in data_files:
+            os.rename(path, prefix + path[len(tmp_prefix):])
+        if extra is not None:
+            atomic_write_json(prefix + '.json', extra)
+        os.rename(tmp_prefix + '.index', prefix + '.index')
+
+        self.history = [entry for entry in self.history if entry['path']
+                        != prefix]
+        self.history.append({'path': prefix, 'step': step, 'psnr': psnr})
+        recent = self.history[-self.keep:] if self.keep > 0 else []
+        scored = [entry for entry in self.history if entry['psnr']
+                  is not None]
+        best = sorted(scored, key=lambda entry: -entry['psnr'
+                      ])[:self.keep_best]
+        kept = [entry for entry in self.history if entry in recent
+                or entry in best]
+        for entry in self.history:
+            if entry not in kept:
+                for path in checkpoint_files(entry['path']):
+                    os.remove(path)
+        self.history = kept
+
+        self._link_latest(prefix)
+        tf.train.update_checkpoint_state(self.save_dir, prefix,
+                [entry['path'] for entry in kept],
+                latest_filename=self.latest_filename)
+        best = self.best
+        atomic_write_json(self.history_path, {'latest': prefix,
+                          'best': (best['path'] if best else None),
+                          'checkpoints': kept})
+
+    def _link_latest(self, prefix):
+
+        # hard links under a temporary prefix, renamed over the previous
+        # ones index file last, so ckpt_path is always one whole checkpoint
+
+        tmp_prefix = self.ckpt_path + '.tmp'
+        for path in checkpoint_files(prefix):
+            if path.endswith('.json'):
+                continue
+            tmp_path = tmp_prefix + path[len(prefix):]
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            os.link(path, tmp_path)
+        paths = sorted(checkpoint_files(tmp_prefix), key=lambda path: \
+                       path.endswith('.index'))
+        for path in paths:
+            os.rename(path, self.ckpt_path + path[len(tmp_prefix):])
+
+    def close(self):
+        """
+        Writes the snapshots still queued and stops the worker thread.
+        """
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+        self.sess.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,551 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+import collections
+import numpy as np
+import scipy.io
+from PSNR import psnr
+
+STORE_INPUT = 'input.npy'
+STORE_GT = 'gt.npy'
+STORE_INDEX = 'index.json'
+SLICE_SHAPES = 'shapes.npy'
+MANIFEST_SUFFIX = '.manifest.json'
+
+_manifests = {}
+
+
+def manifest_paths(data_path):
+    """
+    Where the manifest of a directory is cached: next to the directory, so
+    writing it does not touch the directory mtime, or in the user cache when
+    that location is not writable.
+    """
+    data_path = os.path.abspath(data_path).rstrip(os.sep)
+    fallback = os.path.join(os.path.expanduser('~'), '.cache',
+                            'manifests',
+                            hashlib.sha1(data_path.encode('utf-8'
+                            )).hexdigest() + '.json')
+    return [data_path + MANIFEST_SUFFIX, fallback]
+
+
+def build_manifest(data_path):
+    """
+    Scans a patch directory with a single listdir.
+
+    :returns manifest: {'mtime': directory mtime, 'pairs': [[gt_name,
+        input_name, scale], ...] sorted by patch number}
+    """
+    mtime = os.stat(data_path).st_mtime
+    names = os.listdir(data_path)
+    name_set = set(names)
+    gt_names = [f for f in names if re.search("^\d+.mat$", f)]
+    gt_names.sort(key=lambda f: int(f[:-4]))
+    pairs = []
+    for f in gt_names:
+        for scale in (2, 3, 4):
+            if f[:-4] + '_%d.mat' % scale in name_set:
+                pairs.append([f, f[:-4] + '_%d.mat' % scale, scale])
+    return {'mtime': mtime, 'pairs': pairs}
+
+
+def load_manifest(data_path):
+    """
+    Returns the manifest of a patch directory. It is kept in memory and on
+    disk and only rebuilt when the directory mtime changes, i.e. when files
+    were added, removed or renamed.
+    """
+    key = os.path.abspath(data_path)
+    mtime = os.stat(data_path).st_mtime
+    manifest = _manifests.get(key)
+    if manifest is not None and manifest['mtime'] == mtime:
+        return manifest
+
+    paths = manifest_paths(data_path)
+    for path in paths:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if manifest.get('mtime') == mtime:
+            _manifests[key] = manifest
+            return manifest
+
+    manifest = build_manifest(data_path)
+    for path in paths:
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.rename(path + '.tmp', path)
+            break
+        except (IOError, OSError):
+            continue
+    _manifests[key] = manifest
+    return manifest
+
+
+def get_img_list(data_path):
+    """
+    Lists the ground truth / input pairs of a patch directory, sorted by
+    patch number.
+
+    :param data_path: directory holding N.mat and N_2.mat (N_3, N_4) files
+
+    :returns img_list: list of [gt_path, input_path, scale]
+    """
+    return [[os.path.join(data_path, gt_name),
+            os.path.join(data_path, input_name), scale] for (gt_name,
+            input_name, scale) in load_manifest(data_path)['pairs']]
+
+
+def get_train_list(data_path):
+    """
+    Same as get_img_list without the scale.
+
+    :returns train_list: list of [gt_path, input_path] pairs
+    """
+    return [pair[:2] for pair in get_img_list(data_path)]
+
+
+def dataset_stats(data_path):
+    """
+    Summarises a patch directory from its manifest.
+
+    :returns stats: {'count': pairs, 'patches': ground truth files,
+        'scales': {scale: pairs}}
+    """
+    pairs = load_manifest(data_path)['pairs']
+    scales = {}
+    for pair in pairs:
+        scales[pair[2]] = scales.get(pair[2], 0) + 1
+    return {'count': len(pairs), 'patches': len(set(pair[0]
+            for pair in pairs)), 'scales': scales}
+
+
+class PatchStore(object):
+    """
+    Read-only view of a patch directory packed by `pack_patches`. Inputs and
+    ground truths are memory mapped, so a batch is a slice of two float32
+    arrays and no .mat file is decoded while training.
+
+    :param store_path: directory written by `pack_patches`
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, STORE_INDEX)) as f:
+            self.index = json.load(f)
+        self.inputs = np.load(os.path.join(store_path, STORE_INPUT),
+                              mmap_mode='r')
+        self.gt = np.load(os.path.join(store_path, STORE_GT),
+                          mmap_mode='r')
+        if len(self.inputs) != self.index['count'] or len(self.gt) \
+                != self.index['count']:
+            raise ValueError('Patch store %s is truncated: index lists %d patches, arrays hold %d/%d'
+                              % (store_path, self.index['count'],
+                             len(self.inputs), len(self.gt)))
+
+    def __len__(self):
+        return self.index['count']
+
+    @property
+    def shape(self):
+        return tuple(self.index['shape'])
+
+    def get_batch(self, indices, out=None):
+        """
+        Reads the patches at the given positions.
+
+        :param indices: sequence of patch positions
+        :param out: optional (input, gt) float32 buffers of shape
+            [len(indices), nx, ny, 1] to read into
+
+        :returns input, gt: float32 arrays of shape [len(indices), nx, ny, 1]
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = (np.empty((len(indices), ) + self.shape,
+                   dtype=np.float32), np.empty((len(indices), )
+                   + self.shape, dtype=np.float32))
+        (input_batch, gt_batch) = out
+        if len(indices) and np.all(np.diff(indices) == 1):
+            sl = slice(indices[0], indices[-1] + 1)
+            input_batch[...] = self.inputs[sl]
+            gt_batch[...] = self.gt[sl]
+        else:
+            np.take(self.inputs, indices, axis=0, out=input_batch,
+                    mode='clip')
+            np.take(self.gt, indices, axis=0, out=gt_batch, mode='clip')
+        return (input_batch, gt_batch)
+
+
+def pack_patches(
+    data_path,
+    store_path,
+    gt_key='patch',
+    input_key='patch',
+    ):
+    """
+    Packs a patch directory into one float32 input array, one float32 ground
+    truth array and a small json index. The store is written next to
+    `store_path` and moved into place once complete.
+
+    :param data_path: patch directory, as read by get_train_list
+    :param store_path: output directory
+    :param gt_key: variable name of the ground truth in N.mat
+    :param input_key: variable name of the input in N_2.mat
+
+    :returns count: number of packed patches
+    """
+    train_list = get_train_list(data_path)
+    if not train_list:
+        raise ValueError('No patches found in %s' % data_path)
+    count = len(train_list)
+    shape = scipy.io.loadmat(train_list[0][0])[gt_key].shape[:2]
+
+    tmp_path = store_path.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    inputs = np.lib.format.open_memmap(os.path.join(tmp_path,
+            STORE_INPUT), mode='w+', dtype=np.float32, shape=(count, )
+            + shape + (1, ))
+    gt = np.lib.format.open_memmap(os.path.join(tmp_path, STORE_GT),
+                                   mode='w+', dtype=np.float32,
+                                   shape=(count, ) + shape + (1, ))
+    for (i, pair) in enumerate(train_list):
+        gt[i, :, :, 0] = scipy.io.loadmat(pair[0])[gt_key]
+        inputs[i, :, :, 0] = scipy.io.loadmat(pair[1])[input_key]
+        if i % 10000 == 0:
+            print('packed %d/%d' % (i, count))
+    inputs.flush()
+    gt.flush()
+    del inputs, gt
+
+    found = len(get_train_list(data_path))
+    if found != count:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise ValueError('%s changed while packing: packed %d patches, get_train_list now finds %d'
+                          % (data_path, count, found))
+
+    index = {
+        'count': count,
+        'shape': list(shape) + [1],
+        'dtype': 'float32',
+        'source': os.path.abspath(data_path),
+        'files': [[os.path.basename(p) for p in pair] for pair in
+                  train_list],
+        }
+    with open(os.path.join(tmp_path, STORE_INDEX), 'w') as f:
+        json.dump(index, f)
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.rename(tmp_path, store_path)
+    return count
+
+
+class SliceDataset(object):
+    """
+    Full-size input / ground truth slices from which training patches are cut
+    at batch time. Every batch draws slice, position and one of the eight
+    dihedral transforms per patch and gathers all patches with one fancy
+    index, so no pixel is stored twice.
+
+    The samples are the patches data/aug_train.m would have written, indexed
+    0 .. len - 1 slice by slice, so SAMPLER.EpochSampler draws them like the
+    patches of a PatchStore, sample weights included. A sample picks its
+    slice; the position and transform are drawn from the seed and the
+    indices of the batch, so a batch only depends on its indices.
+
+    :param inputs: float32 array [n, height, width], may be a memmap
+    :param gt: float32 array [n, height, width], may be a memmap
+    :param shapes: int array [n, 2] of the valid (height, width) of every
+        slice. Smaller slices are zero padded in inputs and gt
+    :param patch_size: side of the square training patches
+    :param stride: stride of the materialised patches, it sets the number
+        of samples of every slice
+    :param seed: seed of the positions and transforms, e.g. the seed of the
+        EpochSampler
+    """
+
+    def __init__(
+        self,
+        inputs,
+        gt,
+        shapes,
+        patch_size=256,
+        stride=60,
+        seed=None,
+        ):
+        self.inputs = inputs
+        self.gt = gt
+        self.shapes = np.asarray(shapes, dtype=np.int64)
+        self.patch_size = patch_size
+        self.stride = stride
+        if np.any(self.shapes < patch_size):
+            raise ValueError('All slices must be at least %dx%d'
+                             % (patch_size, patch_size))
+        self.seed = (0 if seed is None else seed)
+        (self.ii, self.jj) = np.mgrid[0:patch_size, 0:patch_size]
+
+        # patches data/aug_train.m would have written: 4 orientations per
+        # stride position. Sample k belongs to the first slice whose end
+        # exceeds k
+
+        positions = ((self.shapes - self.patch_size) // self.stride + 1).prod(axis=1)
+        self.ends = np.cumsum(4 * positions)
+
+    def __len__(self):
+        return int(self.ends[-1])
+
+    @classmethod
+    def from_directory(
+        cls,
+        data_path,
+        gt_key='img_raw',
+        input_key='img_2',
+        **kwargs
+        ):
+        """
+        Loads the N.mat / N_2.mat slice pairs of a directory into memory.
+        """
+        slice_list = get_train_list(data_path)
+        gt_slices = [scipy.io.loadmat(pair[0])[gt_key] for pair in
+                     slice_list]
+        input_slices = [scipy.io.loadmat(pair[1])[input_key] for pair in
+                        slice_list]
+        shapes = np.array([img.shape[:2] for img in gt_slices])
+        (height, width) = shapes.max(axis=0)
+        inputs = np.zeros((len(slice_list), height, width),
+                          dtype=np.float32)
+        gt = np.zeros_like(inputs)
+        for (i, (input_img, gt_img)) in enumerate(zip(input_slices,
+                gt_slices)):
+            inputs[i, :input_img.shape[0], :input_img.shape[1]] = \
+                input_img
+            gt[i, :gt_img.shape[0], :gt_img.shape[1]] = gt_img
+        return cls(inputs, gt, shapes, **kwargs)
+
+    @classmethod
+    def load(cls, store_path, **kwargs):
+        """
+        Memory maps slices written by `save`.
+        """
+        return cls(np.load(os.path.join(store_path, STORE_INPUT),
+                   mmap_mode='r'), np.load(os.path.join(store_path,
+                   STORE_GT), mmap_mode='r'),
+                   np.load(os.path.join(store_path, SLICE_SHAPES)),
+                   **kwargs)
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """
+        Memory maps `path` if it was written by `save`, otherwise loads it as
+        a directory of slice pairs.
+        """
+        if os.path.exists(os.path.join(path, SLICE_SHAPES)):
+            return cls.load(path, **kwargs)
+        return cls.from_directory(path, **kwargs)
+
+    def save(self, store_path):
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        np.save(os.path.join(store_path, STORE_INPUT), self.inputs)
+        np.save(os.path.join(store_path, STORE_GT), self.gt)
+        np.save(os.path.join(store_path, SLICE_SHAPES), self.shapes)
+
+    def sample_batch(self, indices, out=None):
+        """
+        Cuts a batch of randomly placed and transformed patches. The draw is
+        seeded by the seed and the indices, not by any state of this object,
+        so every worker process cuts its own batches and a resumed run cuts
+        the same ones.
+
+        :param indices: sample indices in range(len(self)), e.g. a batch of
+            an EpochSampler
+        :param out: optional (input, gt) float32 buffers of shape
+            [batch_size, patch_size, patch_size, 1] to cut into
+
+        :returns input, gt: float32 arrays of shape [batch_size, patch_size, patch_size, 1]
+        """
+        size = self.patch_size
+        indices = np.asarray(indices, dtype=np.int64)
+        batch_size = len(indices)
+        rng = np.random.RandomState([self.seed] + indices.tolist())
+        n = np.searchsorted(self.ends, indices, side='right')
+        y = (rng.random_sample(batch_size) * (self.shapes[n, 0] - size
+             + 1)).astype(np.int64)
+        x = (rng.random_sample(batch_size) * (self.shapes[n, 1] - size
+             + 1)).astype(np.int64)
+        (transpose, flip_y, flip_x) = rng.randint(2, size=(3,
+                batch_size, 1, 1)).astype(bool)
+
+        # the dihedral transform only permutes the gather indices
+
+        rows = np.where(transpose, self.jj, self.ii)
+        cols = np.where(transpose, self.ii, self.jj)
+        rows = np.where(flip_y, size - 1 - rows, rows)
+        cols = np.where(flip_x, size - 1 - cols, cols)
+        (height, width) = self.inputs.shape[1:]
+        index = (n[:, None, None] * height + y[:, None, None] + rows) \
+            * width + x[:, None, None] + cols
+        if out is None:
+            shape = (batch_size, size, size, 1)
+            out = (np.empty(shape, dtype=np.float32), np.empty(shape,
+                   dtype=np.float32))
+        for (src, dst) in zip((self.inputs, self.gt), out):
+            np.take(src.reshape(-1), index, out=dst.reshape(index.shape),
+                    mode='clip')
+        return out
+
+
+class EvalSet(object):
+    """
+    Evaluation slices decoded once per run into contiguous float32 arrays,
+    with the PSNR of the input against the ground truth computed at load
+    time, so per-epoch evaluation only runs the forward pass. Slices are
+    grouped by size, every group is one batch of the test graph.
+
+    :param inputs: input slices [nx, ny] or [nx, ny, 1], of any sizes
+    :param gt: ground truth slices of the same sizes
+    """
+
+    def __init__(self, inputs, gt):
+        groups = collections.OrderedDict()
+        for (input_img, gt_img) in zip(inputs, gt):
+            groups.setdefault(np.shape(input_img)[:2], []).append((input_img,
+                    gt_img))
+
+        # groups: [(inputs, gt)] float32 arrays [n, nx, ny, 1] per size
+
+        self.groups = []
+        for (shape, pairs) in groups.items():
+            batch = [np.ascontiguousarray(np.reshape(images, (len(pairs), )
+                     + shape + (1, )), dtype=np.float32) for images in
+                     zip(*pairs)]
+            self.groups.append(tuple(batch))
+        self.count = sum(len(group[0]) for group in self.groups)
+        self.baseline_psnr = psnr(np.concatenate([group[0].ravel()
+                                  for group in self.groups]),
+                                  np.concatenate([group[1].ravel()
+                                  for group in self.groups]), 0)
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def from_directory(
+        cls,
+        data_path,
+        count,
+        gt_key='img_raw',
+        input_key='img_2',
+        ):
+        """
+        Loads the first `count` N.mat / N_2.mat pairs of a directory.
+        """
+        pairs = get_train_list(data_path)[:count]
+        if not pairs:
+            raise ValueError('No N.mat / N_2.mat pairs found in %s'
+                             % data_path)
+        inputs = [scipy.io.loadmat(pair[1])[input_key] for pair in pairs]
+        gt = [scipy.io.loadmat(pair[0])[gt_key] for pair in pairs]
+        return cls(inputs, gt)
+
+    @classmethod
+    def open(cls, path, count, **kwargs):
+        """
+        Loads an evaluation set from a PatchStore (see AUGMENT.py test mode)
+        or a directory of .mat slices.
+        """
+        if os.path.exists(os.path.join(path, STORE_INDEX)):
+            store = PatchStore(path)
+            n = min(count, len(store))
+            return cls(store.inputs[:n], store.gt[:n])
+        return cls.from_directory(path, count, **kwargs)
+
+
+class BatchAssembler(object):
+    """
+    Assembles training batches straight into a ring of preallocated,
+    contiguous float32 buffers, so a batch costs no list building, no
+    np.array copy and no float64 to float32 conversion in feed_dict. A short
+    last batch is returned as a shorter view instead of being zero padded.
+
+    :param batch_size: largest batch size
+    :param img_size: patch size (nx, ny)
+    :param num_buffers: number of batches that may be alive at once, e.g.
+        prefetch depth plus the batch in use
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        img_size,
+        num_buffers=1,
+        ):
+        shape = (num_buffers, batch_size, img_size[0], img_size[1], 1)
+        self.inputs = np.zeros(shape, dtype=np.float32)
+        self.gt = np.zeros(shape, dtype=np.float32)
+        self.num_buffers = num_buffers
+        self.next_buffer = 0
+        self.lock = threading.Lock()
+
+    def buffers(self, batch_size):
+        """
+        Hands out the next (input, gt) buffer pair of the ring, cut to
+        batch_size.
+        """
+        with self.lock:
+            i = self.next_buffer
+            self.next_buffer = (i + 1) % self.num_buffers
+        return (self.inputs[i, :batch_size], self.gt[i, :batch_size])
+
+    def load_mat(self, pairs, key='patch'):
+        """
+        Decodes [gt_path, input_path] pairs of .mat patches into a buffer.
+        """
+        (input_batch, gt_batch) = self.buffers(len(pairs))
+        for (i, pair) in enumerate(pairs):
+            input_batch[i, :, :, 0] = scipy.io.loadmat(pair[1])[key]
+            gt_batch[i, :, :, 0] = scipy.io.loadmat(pair[0])[key]
+        return (input_batch, gt_batch)
+
+    def read_store(self, patch_store, indices):
+        return patch_store.get_batch(indices,
+                                     out=self.buffers(len(indices)))
+
+    def sample_slices(self, slice_dataset, indices):
+        return slice_dataset.sample_batch(indices,
+                out=self.buffers(len(indices)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a patch directory into a memory-mapped patch store.')
+    parser.add_argument('data_path')
+    parser.add_argument('store_path')
+    parser.add_argument('--gt_key', default='patch')
+    parser.add_argument('--input_key', default='patch')
+    parser.add_argument('--slices', action='store_true',
+                        help='pack full-size img_raw / img_2 slices for SliceDataset')
+    args = parser.parse_args()
+    if args.slices:
+        slices = SliceDataset.from_directory(args.data_path)
+        slices.save(args.store_path)
+        print('packed %d slices into %s' % (len(slices.shapes),
+              args.store_path))
+    else:
+        count = pack_patches(args.data_path, args.store_path,
+                             args.gt_key, args.input_key)
+        print('packed %d patches into %s' % (count, args.store_path))
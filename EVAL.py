@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import math
+import time
+import threading
+import tensorflow as tf
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def psnr_op(prediction, gt):
+    """
+    In-graph PSNR.psnr over a whole batch, for images scaled to [0, 1].
+    """
+    mse = tf.reduce_mean(tf.square(gt - prediction))
+    return 20 * tf.log(1.0 / tf.sqrt(mse + 1e-10)) / math.log(10)
+
+
+def l2_loss(error):
+    """
+    Loss of the l2 training files, half the summed squared error.
+    """
+    return tf.reduce_mean(tf.nn.l2_loss(error))
+
+
+def eval_metrics(
+    output,
+    test_input,
+    test_gt,
+    residual=False,
+    loss_fn=l2_loss,
+    ):
+    """
+    Inference-only evaluation ops. They only depend on the test placeholders,
+    so running them never touches the optimizer or the training batch.
+
+    :param output: network output on test_input
+    :param residual: the network predicts gt - input
+    :param loss_fn: loss of the training file as a function of the output
+        error, prediction - gt
+
+    :returns prediction, loss, psnr: prediction tensor and scalar metrics
+    """
+    prediction = (output + test_input if residual else output)
+    loss = loss_fn(prediction - test_gt)
+    return (prediction, loss, psnr_op(prediction, test_gt))
+
+
+def run_eval(
+    sess,
+    eval_set,
+    test_input,
+    test_gt,
+    loss,
+    psnr,
+    prediction=None,
+    ):
+    """
+    Runs the ops of eval_metrics once per slice size of a DATA.EvalSet.
+
+    :returns loss, psnr, predictions: the loss summed over the groups, the
+        PSNR over all their pixels and the prediction of every group, or
+        None without a prediction tensor
+    """
+    (total_loss, squared_error, pixels) = (0.0, 0.0, 0)
+    predictions = ([] if prediction is not None else None)
+    for (inputs, gt) in eval_set.groups:
+        fetches = [loss, psnr] + ([prediction] if prediction
+                                  is not None else [])
+        results = sess.run(fetches, feed_dict={test_input: inputs,
+                           test_gt: gt})
+        total_loss += results[0]
+
+        # psnr_op is -10 log10(mse + 1e-10), the MSE of the group is
+        # recovered to combine the groups by pixel count
+
+        squared_error += (10 ** (-results[1] / 10) - 1e-10) * gt.size
+        pixels += gt.size
+        if prediction is not None:
+            predictions.append(results[2])
+    mse = max(squared_error / pixels, 0.0)
+    return (total_loss, 20 * math.log10(1.0 / math.sqrt(mse + 1e-10)),
+            predictions)
+
+
+def running_means(tensors, scope='running_means'):
+    """
+    On-device running means of scalar tensors. Running `update` every step
+    costs no host copy; the means are fetched only when they are logged.
+
+    :param tensors: scalar tensors to average
+    :param scope: variable scope of the accumulators
+
+    :returns means, update, reset: mean tensors, op accumulating the current
+        values, op clearing the accumulators
+    """
+    with tf.variable_scope(scope) as vs:
+        metrics = [tf.metrics.mean(tensor) for tensor in tensors]
+    reset = \
+        tf.variables_initializer(tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES,
+                                 scope=vs.name))
+    return ([mean for (mean, _) in metrics], tf.group(*[update
+            for (_, update) in metrics]), reset)
+
+
+class BackgroundEvaluator(object):
+    """
+    Evaluates snapshots of the training weights on a worker thread, in a
+    graph and session of its own, so evaluation can run every few steps
+    without stalling training. The training thread only pays for copying
+    the variables out of its session.
+
+    Variables are matched by name, so build_fn must create them under the
+    same variable scope as the training graph.
+
+    :param build_fn: callable building the network on an input tensor and
+        returning (output, weights), e.g. MODEL.model
+    :param eval_set: DATA.EvalSet to evaluate on
+    :param every: global steps between two evaluations
+    :param residual: the network predicts gt - input
+    :param loss_fn: loss of the training file, see eval_metrics
+    :param scope: variable scope of the network
+    :param config: tf.ConfigProto of the evaluation session
+    """
+
+    def __init__(
+        self,
+        build_fn,
+        eval_set,
+        every=500,
+        residual=False,
+        loss_fn=l2_loss,
+        scope='foo',
+        config=None,
+        ):
+        self.eval_set = eval_set
+        self.every = every
+        self.results = []
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            test_input = tf.placeholder(tf.float32, shape=(None, None,
+                    None, 1))
+            test_gt = tf.placeholder(tf.float32, shape=(None, None,
+                    None, 1))
+            with tf.variable_scope(scope):
+                (output, _) = build_fn(test_input)
+            (_, loss, psnr) = eval_metrics(output, test_input, test_gt,
+                    residual, loss_fn)
+            self.variables = tf.global_variables()
+            init = tf.global_variables_initializer()
+        if config is None:
+            config = tf.ConfigProto(allow_soft_placement=True)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.sess.run(init)
+        self.fetches = [test_input, test_gt, loss, psnr]
+        self.names = [var.op.name for var in self.variables]
+
+        # a single slot: if evaluation falls behind, the newest snapshot wins
+
+        self.pending = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def maybe_submit(self, sess, step):
+        """
+        Snapshots the weights of sess for evaluation if step is a multiple of
+        `every`.
+
+        :returns submitted: whether a snapshot was taken
+        """
+        if self.every <= 0 or step % self.every:
+            return False
+        self.submit(sess, step)
+        return True
+
+    def submit(self, sess, step):
+        by_name = dict((var.op.name, var) for var in
+                       sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+        values = sess.run([by_name[name] for name in self.names])
+        try:
+            self.pending.get_nowait()
+        except queue.Empty:
+            pass
+        self.pending.put((step, values))
+
+    def _run(self):
+        while True:
+            job = self.pending.get()
+            if job is None:
+                return
+            (step, values) = job
+            for (var, value) in zip(self.variables, values):
+                var.load(value, self.sess)
+            start = time.time()
+            (loss, psnr, _) = run_eval(self.sess, self.eval_set,
+                    *self.fetches)
+            self.results.append({
+                'step': int(step),
+                'loss': float(loss),
+                'psnr': float(psnr),
+                'seconds': time.time() - start,
+                })
+            print('[eval step %d] loss %.4f\t PSNR %f (baseline %f)'
+                  % (step, loss, psnr, self.eval_set.baseline_psnr))
+
+    def close(self):
+        if self.thread.is_alive():
+
+            # let the worker finish the snapshot it has queued
+
+            self.pending.put(None)
+            self.thread.join()
+        self.sess.close()
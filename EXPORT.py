@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import re
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from MODEL import unet, restore_unet
+from SESSION import add_session_args, make_session, session_args
+
+INPUT_NAME = 'input'
+OUTPUT_NAME = 'output'
+
+
+def checkpoint_config(ckpt_path):
+    """
+    Reads the U-Net parametrization back from a checkpoint.
+
+    :returns scope, layers, features_root, channels: the variable scope the
+        network was built in and the unet arguments
+    """
+    shapes = tf.train.NewCheckpointReader(ckpt_path).get_variable_to_shape_map()
+    scope = None
+    layers = 0
+    for name in shapes:
+        if name.endswith('down_conv_00_w1'):
+            scope = name[:-len('down_conv_00_w1')].rstrip('/')
+            (_, _, channels, features_root) = shapes[name]
+        match = re.search(r'down_conv_(\d+)_w2$', name)
+        if match:
+            layers = max(layers, int(match.group(1)))
+    if scope is None:
+        raise ValueError('%s is not a U-Net checkpoint' % ckpt_path)
+    return (scope, layers, features_root, channels)
+
+
+def fold_constants(graph_def, output_names):
+    """
+    Replaces every stateless op that only depends on constants by a Const
+    node holding its value, e.g. the folded kernels of unet(fold_bn=True)
+    once the variables are frozen, and drops the nodes no output needs.
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    constant = set()
+    for op in graph.get_operations():
+        if op.type == 'Const' or op.inputs and len(op.outputs) == 1 \
+            and not op.op_def.is_stateful and not op.control_inputs \
+            and all(tensor.op.name in constant for tensor in op.inputs):
+            constant.add(op.name)
+
+    # only the constant ops that feed the rest of the graph are evaluated
+
+    folded = set(tensor.op.name for op in graph.get_operations()
+                 if op.name not in constant for tensor in op.inputs
+                 if tensor.op.name in constant and tensor.op.type
+                 != 'Const')
+    folded |= set(name for name in output_names if name in constant)
+    folded = sorted(folded)
+    with tf.Session(graph=graph) as sess:
+        values = sess.run([graph.get_tensor_by_name(name + ':0')
+                          for name in folded])
+
+    output_def = tf.GraphDef()
+    replaced = dict(zip(folded, values))
+    for node in graph_def.node:
+        if node.name not in replaced:
+            output_def.node.extend([node])
+            continue
+        value = replaced[node.name]
+        const = output_def.node.add()
+        const.name = node.name
+        const.op = 'Const'
+        const.device = node.device
+        const.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+        const.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+    return tf.graph_util.extract_sub_graph(output_def, output_names)
+
+
+def export_unet(ckpt_path, output_path):
+    """
+    Writes a frozen inference graph of a U-Net checkpoint: the batch norms
+    are folded into the convolutions with their population statistics,
+    dropout is off and the weights are constants. The graph takes any
+    [batch, height, width, channels] float32 `input` and returns `output`.
+
+    The checkpoint may come from either batch norm implementation of
+    MODEL.unet, it is read with restore_unet.
+
+    :returns graph_def: the exported graph
+    """
+    (scope, layers, features_root, channels) = checkpoint_config(ckpt_path)
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, None, None, channels],
+                           name=INPUT_NAME)
+        with tf.variable_scope(scope):
+            (output, _) = unet(
+                x,
+                False,
+                keep_prob=1,
+                channels=channels,
+                layers=layers,
+                features_root=features_root,
+                device=None,
+                fold_bn=True,
+                )
+        tf.identity(output, name=OUTPUT_NAME)
+        init = tf.global_variables_initializer()
+
+    with make_session(graph) as sess:
+        sess.run(init)
+        restored = set(restore_unet(sess, ckpt_path))
+        missing = [var.op.name for var in graph.get_collection('variables')
+                   if var.op.name not in restored]
+        if missing:
+            print('not in the checkpoint, exported with initial values:',
+                  ', '.join(missing))
+        graph_def = tf.graph_util.convert_variables_to_constants(sess,
+                graph.as_graph_def(), [OUTPUT_NAME])
+    graph_def = fold_constants(graph_def, [OUTPUT_NAME])
+    with open(output_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    return graph_def
+
+
+def load_frozen(path, graph=None):
+    """
+    Imports a graph written by export_unet.
+
+    :returns graph, input, output
+    """
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = (tf.Graph() if graph is None else graph)
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    return (graph, graph.get_tensor_by_name(INPUT_NAME + ':0'),
+            graph.get_tensor_by_name(OUTPUT_NAME + ':0'))
+
+
+def verify_export(
+    ckpt_path,
+    graph_path,
+    batch_size=1,
+    img_size=256,
+    steps=20,
+    session_kwargs={},
+    ):
+    """
+    Runs the checkpoint in MODEL.unet in inference mode and the exported
+    graph on the same random batch.
+
+    :returns results: {'max_abs_diff', 'original', 'exported'}, the latter
+        two {'load_sec', 'images_per_sec'}. load_sec covers building or
+        importing the graph, restoring the weights and the first step
+    """
+    (scope, layers, features_root, channels) = checkpoint_config(ckpt_path)
+    batch = np.random.RandomState(0).rand(batch_size, img_size,
+            img_size, channels).astype(np.float32)
+    results = {}
+    outputs = []
+    for name in ('original', 'exported'):
+        start = time.time()
+        if name == 'original':
+            graph = tf.Graph()
+            with graph.as_default():
+                x = tf.placeholder(tf.float32, [None, None, None,
+                                   channels])
+                with tf.variable_scope(scope):
+                    (output, _) = unet(
+                        x,
+                        False,
+                        channels=channels,
+                        layers=layers,
+                        features_root=features_root,
+                        device=None,
+                        )
+                init = tf.global_variables_initializer()
+        else:
+            (graph, x, output) = load_frozen(graph_path)
+        with make_session(graph, **session_kwargs) as sess:
+            if name == 'original':
+                sess.run(init)
+                restore_unet(sess, ckpt_path)
+            outputs.append(sess.run(output, feed_dict={x: batch}))
+            load_sec = time.time() - start
+            start = time.time()
+            for _ in range(steps):
+                sess.run(output, feed_dict={x: batch})
+            results[name] = {'load_sec': load_sec,
+                             'images_per_sec': steps * batch_size
+                             / (time.time() - start)}
+    results['max_abs_diff'] = float(np.abs(outputs[0]
+                                    - outputs[1]).max())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a U-Net checkpoint as a frozen inference graph with the batch norms folded into the convolutions.')
+    parser.add_argument('model_path')
+    parser.add_argument('--output', default='unet_frozen.pb')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare outputs and speed with the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest accepted absolute output difference')
+    add_session_args(parser)
+    args = parser.parse_args()
+
+    graph_def = export_unet(args.model_path, args.output)
+    print('wrote %s: %d nodes, %.1fMB' % (args.output,
+          len(graph_def.node), os.path.getsize(args.output) / 2 ** 20))
+    if args.verify:
+        results = verify_export(
+            args.model_path,
+            args.output,
+            args.batch_size,
+            args.img_size,
+            args.steps,
+            session_kwargs=session_args(args),
+            )
+        for name in ('original', 'exported'):
+            print('%-8s load %6.2fs  %8.2f images/sec' % (name,
+                  results[name]['load_sec'], results[name]['images_per_sec'
+                  ]))
+        print('max abs difference %g' % results['max_abs_diff'])
+        if results['max_abs_diff'] > args.tolerance:
+            raise SystemExit('exported graph differs by more than %g'
+                             % args.tolerance)
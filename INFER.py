@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import time
+import argparse
+import numpy as np
+import scipy.io
+import tensorflow as tf
+from MODEL import model, unet, restore_unet
+from EXPORT import checkpoint_config, load_frozen
+from SESSION import add_session_args, make_session, model_device, \
+    session_args
+
+# keys of the input slice in the test .mat files, as read by TEST.py
+
+INPUT_KEYS = ('img_2', 'img_3', 'img_4', 'patch')
+
+
+def checkpoint_scope(ckpt_path, suffix):
+    """
+    :returns scope: variable scope of the variable ending in `suffix`, or
+        None if the checkpoint has none
+    """
+    for name in tf.train.NewCheckpointReader(ckpt_path).get_variable_to_shape_map():
+        if name.endswith(suffix):
+            return name[:-len(suffix)].rstrip('/')
+    return None
+
+
+def pad_to_multiple(batch, multiple):
+    """
+    Mirrors the bottom and right border of an NHWC batch until height and
+    width are multiples of `multiple`.
+
+    :returns padded, height, width: the padded batch and the size to crop
+        the prediction back to
+    """
+    (height, width) = batch.shape[1:3]
+    pad = [(0, 0), (0, -height % multiple), (0, -width % multiple), (0,
+           0)]
+    if not any(after for (_, after) in pad):
+        return (batch, height, width)
+    return (np.pad(batch, pad, mode='symmetric'), height, width)
+
+
+class Predictor(object):
+    """
+    Runs a trained network on slices of any batch size, height and width.
+    The graph is built once on an input of unknown shape and kept with its
+    session, so a new slice size does not rebuild or reload anything.
+
+    U-Net inputs are padded to a multiple of 2 ** (layers - 1), the stride
+    of its pooling, and the predictions are cropped back. VDSR is fully
+    convolutional and runs on the slices as they are.
+
+    :param model_path: checkpoint of MODEL.unet or MODEL.model, the network
+        is read from its variable names, or a graph written by EXPORT.py
+    :param residual: the network predicts gt - input, as in the *_res
+        training files
+    :param batch_size: most slices run in one step, None runs every call in
+        one step
+    :param device: device to build the network on
+    :param session_kwargs: passed to SESSION.make_session
+    """
+
+    def __init__(
+        self,
+        model_path,
+        residual=False,
+        batch_size=None,
+        device='/gpu:0',
+        session_kwargs={},
+        ):
+        self.residual = residual
+        self.batch_size = batch_size
+        if model_path.endswith('.pb'):
+            (self.graph, self.input, self.output) = \
+                load_frozen(model_path)
+            pools = [op for op in self.graph.get_operations() if op.type
+                     == 'MaxPool']
+            self.multiple = 2 ** len(pools)
+            self.sess = make_session(self.graph, **session_kwargs)
+            return
+
+        unet_scope = checkpoint_scope(model_path, 'down_conv_00_w1')
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if unet_scope is not None:
+                (scope, layers, features_root, channels) = \
+                    checkpoint_config(model_path)
+                self.input = tf.placeholder(tf.float32, [None, None,
+                        None, channels])
+                with tf.variable_scope(scope):
+                    (self.output, weights) = unet(
+                        self.input,
+                        False,
+                        channels=channels,
+                        layers=layers,
+                        features_root=features_root,
+                        device=device,
+                        )
+                self.multiple = 2 ** (layers - 1)
+            else:
+                scope = checkpoint_scope(model_path, 'conv_00_w')
+                if scope is None:
+                    raise ValueError('%s holds neither a U-Net nor a VDSR'
+                                     % model_path)
+                self.input = tf.placeholder(tf.float32, [None, None,
+                        None, 1])
+                with tf.variable_scope(scope):
+                    (self.output, weights) = model(self.input,
+                            device=device)
+                self.multiple = 1
+            init = tf.global_variables_initializer()
+            saver = tf.train.Saver(weights)
+            self.sess = make_session(self.graph, **session_kwargs)
+            self.sess.run(init)
+            if unet_scope is not None:
+                restored = restore_unet(self.sess, model_path, weights)
+                print('restored %d variables from %s' % (len(restored),
+                      model_path))
+            else:
+                saver.restore(self.sess, model_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def predict(self, images):
+        """
+        :param images: one slice [H, W], slices [N, H, W] or an NHWC batch
+
+        :returns prediction: float32 array of the shape of images
+        """
+        images = np.asarray(images, dtype=np.float32)
+        batch = images
+        if images.ndim < 4:
+            batch = images.reshape((-1, ) + images.shape[-2:] + (1, ))
+        (padded, height, width) = pad_to_multiple(batch, self.multiple)
+        step = self.batch_size or len(padded)
+        outputs = [self.sess.run(self.output,
+                   feed_dict={self.input: padded[i:i + step]}) for i in
+                   range(0, len(padded), step)]
+        prediction = np.concatenate(outputs)[:, :height, :width]
+        if self.residual:
+            prediction = prediction + batch
+        return prediction.reshape(images.shape)
+
+    def close(self):
+        self.sess.close()
+
+
+def load_slice(path):
+    mat_dict = scipy.io.loadmat(path)
+    for key in INPUT_KEYS:
+        if key in mat_dict:
+            return mat_dict[key]
+    raise ValueError('%s has none of %s' % (path, ', '.join(INPUT_KEYS)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a trained network on .mat slices of any size.')
+    parser.add_argument('model_path',
+                        help='checkpoint, or a graph written by EXPORT.py')
+    parser.add_argument('inputs', nargs='+', help='.mat slices')
+    parser.add_argument('--output_dir', default='./prediction')
+    parser.add_argument('--residual', action='store_true',
+                        help='the network predicts gt - input')
+    parser.add_argument('--batch_size', type=int)
+    add_session_args(parser)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    with Predictor(args.model_path, args.residual, args.batch_size,
+                   model_device(args.cpu), session_args(args)) as \
+        predictor:
+        for path in args.inputs:
+            image = load_slice(path)
+            start = time.time()
+            prediction = predictor.predict(image)
+            print('%s %dx%d: %.3fs' % (path, image.shape[0],
+                  image.shape[1], time.time() - start))
+            scipy.io.savemat(os.path.join(args.output_dir,
+                             os.path.basename(path)),
+                             mdict={'img': prediction})
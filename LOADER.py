@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import signal
+import time
+import argparse
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from functools import partial
+import numpy as np
+import scipy.io
+import tensorflow as tf
+from DATA import PatchStore, get_train_list
+from SAMPLER import EpochSampler
+
+
+def _ignore_sigint():
+
+    # workers leave SIGINT to the training process, which closes the pool
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# load_fn and shared data of a worker process, set once by _init_worker
+
+_worker = {}
+
+
+def _init_worker(load_fn, shared):
+    _ignore_sigint()
+    _worker['load_fn'] = load_fn
+    _worker['shared'] = shared
+
+
+def _timed_load(load_fn, shared, task):
+    start = time.time()
+    if shared is None:
+        batch = load_fn(task)
+    else:
+        batch = load_fn(shared, task)
+    return (batch, time.time() - start)
+
+
+def _worker_load(task):
+    return _timed_load(_worker['load_fn'], _worker['shared'], task)
+
+
+class BatchPrefetcher(object):
+    """
+    Builds the next `depth` batches on a pool of worker threads (or
+    processes) while the current training step runs.
+
+    :param load_fn: callable building one batch from one task, e.g. an offset,
+        or load_fn(shared, task) if shared is given
+    :param depth: number of batches kept in flight
+    :param num_workers: number of worker threads or processes
+    :param use_processes: use worker processes instead of threads. load_fn
+        and shared must then be picklable; they are sent to every worker
+        once, only the tasks are sent per batch
+    :param ordered: yield batches in task order. If False batches are
+        yielded as soon as they are ready
+    :param shared: data every batch reads, e.g. train_list
+    :param timer: optional TIMING.StepTimer, the time a worker spent
+        building each batch is added to it as 'load'
+    """
+
+    def __init__(
+        self,
+        load_fn,
+        depth=4,
+        num_workers=2,
+        use_processes=False,
+        ordered=True,
+        shared=None,
+        timer=None,
+        ):
+        self.depth = max(1, depth)
+        self.ordered = ordered
+        self.timer = timer
+        if use_processes:
+            self.pool = multiprocessing.Pool(num_workers, _init_worker,
+                    (load_fn, shared))
+            self.load_fn = _worker_load
+        else:
+            self.pool = ThreadPool(num_workers)
+            self.load_fn = partial(_timed_load, load_fn, shared)
+        self.wait_times = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_ready(self, pending):
+        if self.ordered:
+            result = pending.popleft()
+            while not result.ready():
+                result.wait(0.1)
+            return result
+        while True:
+            for result in pending:
+                if result.ready():
+                    pending.remove(result)
+                    return result
+            pending[0].wait(0.01)
+
+    def iterate(self, tasks):
+        """
+        Yields load_fn(task) for every task, keeping `depth` batches in flight.
+        The time spent waiting for each batch is appended to `wait_times`.
+
+        :param tasks: iterable of arguments for load_fn
+        """
+        tasks = iter(tasks)
+        pending = collections.deque()
+
+        def submit():
+            for task in tasks:
+                pending.append(self.pool.apply_async(self.load_fn,
+                               (task, )))
+                return
+
+        for _ in range(self.depth):
+            submit()
+        while pending:
+            start = time.time()
+            result = self._next_ready(pending)
+            self.wait_times.append(time.time() - start)
+            submit()
+            (batch, seconds) = result.get()
+            if self.timer is not None:
+                self.timer.add('load', seconds)
+            yield batch
+
+    def pop_wait_stats(self):
+        """
+        Summarises and clears the recorded wait times.
+
+        :returns mean, max, total: wait per batch in seconds
+        """
+        waits = np.array(self.wait_times or [0.0])
+        del self.wait_times[:]
+        return (waits.mean(), waits.max(), waits.sum())
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.terminate()
+            self.pool.join()
+
+
+def load_mat_pair(gt_path, input_path, key='patch'):
+    """
+    Decodes one ground truth / input pair of .mat patches.
+
+    :returns input, gt: float32 arrays of shape [nx, ny, 1]
+    """
+    if isinstance(gt_path, bytes):
+
+        # tf.py_func hands string tensors over as bytes
+
+        (gt_path, input_path) = (gt_path.decode('utf-8'),
+                                 input_path.decode('utf-8'))
+    input_img = scipy.io.loadmat(input_path)[key]
+    gt_img = scipy.io.loadmat(gt_path)[key]
+    return (input_img.astype(np.float32)[..., np.newaxis],
+            gt_img.astype(np.float32)[..., np.newaxis])
+
+
+def make_dataset(
+    train_list,
+    batch_size,
+    img_size,
+    num_parallel_calls=8,
+    prefetch_batches=2,
+    patch_store=None,
+    slice_dataset=None,
+    sampler=None,
+    first_epoch=0,
+    first_step=0,
+    ):
+    """
+    Builds a tf.data pipeline that decodes, batches and prefetches training
+    pairs on parallel calls. The batches are those of an EpochSampler, a
+    fresh permutation of all of train_list per epoch drawn from its seed, so
+    the pipeline of a resumed run continues where the last one stopped.
+
+    :param train_list: [gt_path, input_path] pairs, or store positions when
+        patch_store is given, or sample indices when slice_dataset is given
+    :param batch_size: samples per batch
+    :param img_size: patch size (nx, ny)
+    :param num_parallel_calls: number of batches decoded in parallel
+    :param prefetch_batches: number of batches prepared ahead of the step
+    :param patch_store: optional DATA.PatchStore to read from
+    :param slice_dataset: optional DATA.SliceDataset to cut patches from
+    :param sampler: SAMPLER.EpochSampler over train_list, an unseeded one
+        if None
+    :param first_epoch: epoch of the first batch
+    :param first_step: step of the first batch within first_epoch
+
+    :returns dataset: yields (input, gt) batches of shape [batch_size, nx, ny, 1]
+    """
+    if sampler is None:
+        sampler = EpochSampler(len(train_list), batch_size)
+    shape = [(batch_size if sampler.drop_last else None), img_size[0],
+             img_size[1], 1]
+
+    def batches():
+        (epoch, step) = (first_epoch, first_step)
+        while True:
+            for indices in sampler.batches(epoch, step):
+                yield indices
+            (epoch, step) = (epoch + 1, 0)
+
+    def load_mat_batch(indices):
+        pairs = [load_mat_pair(*train_list[i][:2]) for i in indices]
+        return (np.stack([pair[0] for pair in pairs]),
+                np.stack([pair[1] for pair in pairs]))
+
+    # a store read is cheapest per batch and a slice batch is cut with one
+    # gather; .mat batches are decoded in parallel across batches
+
+    if slice_dataset is None and patch_store is None:
+        load_batch = load_mat_batch
+    else:
+        positions = np.asarray(train_list, dtype=np.int64)
+        read = (patch_store.get_batch if slice_dataset is None else
+                slice_dataset.sample_batch)
+        load_batch = lambda indices: read(positions[indices])
+    dataset = tf.data.Dataset.from_generator(batches, tf.int64,
+            tf.TensorShape([None]))
+    dataset = dataset.map(lambda indices: tf.py_func(load_batch,
+                          [indices], [tf.float32, tf.float32],
+                          stateful=False),
+                          num_parallel_calls=num_parallel_calls)
+
+    def set_shape(input_batch, gt_batch):
+        input_batch.set_shape(shape)
+        gt_batch.set_shape(shape)
+        return (input_batch, gt_batch)
+
+    dataset = dataset.map(set_shape)
+    return dataset.prefetch(prefetch_batches)
+
+
+def measure_throughput(next_batch, steps, batch_size, warmup=5):
+    """
+    Times `steps` calls of next_batch after `warmup` untimed calls.
+
+    :returns samples_per_sec: loader throughput
+    """
+    for _ in range(warmup):
+        next_batch()
+    start = time.time()
+    for _ in range(steps):
+        next_batch()
+    return steps * batch_size / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the samples/sec of the sequential, prefetching and tf.data loaders.')
+    parser.add_argument('data_path')
+    parser.add_argument('--store_path')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--num_parallel_calls', type=int, default=8)
+    parser.add_argument('--prefetch_depth', type=int, default=4)
+    parser.add_argument('--prefetch_workers', type=int, default=2)
+    args = parser.parse_args()
+
+    patch_store = None
+    if args.store_path:
+        patch_store = PatchStore(args.store_path)
+        train_list = list(range(len(patch_store)))
+    else:
+        train_list = get_train_list(args.data_path)
+    batch_size = args.batch_size
+    num_batches = len(train_list) // batch_size
+
+    def load_batch(offset):
+        target_list = train_list[offset:offset + batch_size]
+        if patch_store is not None:
+            return patch_store.get_batch(target_list)
+        pairs = [load_mat_pair(pair[0], pair[1]) for pair in
+                 target_list]
+        return (np.stack([p[0] for p in pairs]), np.stack([p[1]
+                for p in pairs]))
+
+    offsets = [(i % num_batches) * batch_size for i in
+               range(args.steps + 5)]
+    it = iter(offsets)
+    print('sequential: %.1f samples/sec' % measure_throughput(lambda : \
+            load_batch(next(it)), args.steps, batch_size))
+
+    with BatchPrefetcher(load_batch, depth=args.prefetch_depth,
+                         num_workers=args.prefetch_workers) as \
+        prefetcher:
+        batches = prefetcher.iterate(offsets)
+        print('prefetch (depth %d, %d workers): %.1f samples/sec'
+              % (args.prefetch_depth, args.prefetch_workers,
+              measure_throughput(lambda : next(batches), args.steps,
+              batch_size)))
+
+    dataset = make_dataset(train_list, batch_size, (args.img_size,
+                           args.img_size),
+                           num_parallel_calls=args.num_parallel_calls,
+                           patch_store=patch_store)
+    next_op = dataset.make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+        print('tf.data (%d parallel calls): %.1f samples/sec'
+              % (args.num_parallel_calls, measure_throughput(lambda : \
+              sess.run(next_op), args.steps, batch_size)))
@@ -7,6 +7,7 @@ import tensorflow as tf
 import numpy as np
 
 import os
+import re
 import shutil
 from collections import OrderedDict
 import logging
@@ -16,21 +17,27 @@ from tf_unet.layers import weight_variable, weight_variable_devonc, \
     pixel_wise_softmax_2, cross_entropy
 
 
+BN_EPSILON = 1e-3
+
+
 # this is a simpler version of Tensorflow's 'official' version. See:
 # https://github.com/tensorflow/tensorflow/blob/master/tensorflow/contrib/layers/python/layers/layers.py#L102
 
 def batch_norm_wrapper(inputs, is_training, decay=0.999):
 
-    epsilon = 1e-3
-    scale = tf.Variable(tf.ones([inputs.get_shape()[-1]]))
-    beta = tf.Variable(tf.zeros([inputs.get_shape()[-1]]))
-    pop_mean = tf.Variable(tf.zeros([inputs.get_shape()[-1]]),
-                           trainable=False)
-    pop_var = tf.Variable(tf.ones([inputs.get_shape()[-1]]),
-                          trainable=False)
+    # the statistics and parameters stay float32 in reduced precision, only
+    # the normalisation itself runs in the dtype of the inputs. They are
+    # named variables of the current scope, so a graph built with reuse
+    # shares them and a checkpoint keeps the population statistics
+
+    dtype = inputs.dtype.base_dtype
+    epsilon = BN_EPSILON
+    (scale, beta, pop_mean, pop_var) = \
+        batch_norm_variables(inputs.get_shape()[-1])
 
     if is_training:
-        (batch_mean, batch_var) = tf.nn.moments(inputs, [0, 1, 2])
+        (batch_mean, batch_var) = tf.nn.moments(tf.cast(inputs,
+                tf.float32), [0, 1, 2])
 
         # Small epsilon value for the BN transform
 
@@ -46,23 +53,148 @@ def batch_norm_wrapper(inputs, is_training, decay=0.999):
         with tf.control_dependencies([train_mean, train_var]):
             return tf.nn.batch_normalization(
                 inputs,
-                batch_mean,
-                batch_var,
-                beta,
-                scale,
+                tf.cast(batch_mean, dtype),
+                tf.cast(batch_var, dtype),
+                tf.cast(beta, dtype),
+                tf.cast(scale, dtype),
                 epsilon,
                 )
     else:
         return tf.nn.batch_normalization(
             inputs,
-            pop_mean,
-            pop_var,
-            beta,
-            scale,
+            tf.cast(pop_mean, dtype),
+            tf.cast(pop_var, dtype),
+            tf.cast(beta, dtype),
+            tf.cast(scale, dtype),
             epsilon,
             )
 
 
+def batch_norm_variables(channels, beta_initializer=0.0):
+    """
+    The scale, beta, pop_mean and pop_var of a batch norm, created with
+    tf.get_variable in the current variable scope.
+    """
+
+    scale = tf.get_variable('scale', [channels],
+                            initializer=tf.ones_initializer())
+    beta = tf.get_variable('beta', [channels],
+                           initializer=tf.constant_initializer(beta_initializer))
+    pop_mean = tf.get_variable('pop_mean', [channels],
+                               initializer=tf.zeros_initializer(),
+                               trainable=False)
+    pop_var = tf.get_variable('pop_var', [channels],
+                              initializer=tf.ones_initializer(),
+                              trainable=False)
+    return (scale, beta, pop_mean, pop_var)
+
+
+def fused_batch_norm(inputs, is_training, decay=0.999,
+                     beta_initializer=0.0):
+    """
+    batch_norm_wrapper as a single FusedBatchNorm kernel, on the variables
+    of batch_norm_variables.
+
+    Like batch_norm_wrapper, the parameters and statistics stay float32 for
+    reduced precision inputs. The population variance is updated with the
+    unbiased batch variance the kernel returns.
+    """
+
+    epsilon = BN_EPSILON
+    (scale, beta, pop_mean, pop_var) = \
+        batch_norm_variables(inputs.get_shape()[-1], beta_initializer)
+
+    if is_training:
+        (outputs, batch_mean, batch_var) = tf.nn.fused_batch_norm(inputs,
+                scale, beta, epsilon=epsilon, is_training=True)
+        train_mean = tf.assign(pop_mean, pop_mean * decay + batch_mean
+                               * (1 - decay))
+        train_var = tf.assign(pop_var, pop_var * decay + batch_var * (1
+                              - decay))
+        with tf.control_dependencies([train_mean, train_var]):
+            return tf.identity(outputs)
+    else:
+        (outputs, _, _) = tf.nn.fused_batch_norm(
+            inputs,
+            scale,
+            beta,
+            mean=pop_mean,
+            variance=pop_var,
+            epsilon=epsilon,
+            is_training=False,
+            )
+        return outputs
+
+
+def batch_norm_bias_relu(
+    inputs,
+    bias_name,
+    is_training,
+    decay=0.999,
+    fused=False,
+    ):
+    """
+    The batch norm, bias and ReLU that follow every U-Net convolution. The
+    batch norm variables are created under the scope `bias_name`_bn.
+
+    With fused=True the bias is folded into the batch norm beta, which it
+    duplicates, and beta starts at the 0.1 the bias was initialised with.
+
+    :returns normed, activation, bias: the batch norm output, the ReLU
+        output and the bias variable, or beta when fused
+    """
+
+    dtype = inputs.dtype.base_dtype
+    if fused:
+        with tf.variable_scope(bias_name + '_bn') as scope:
+            normed = fused_batch_norm(inputs, is_training, decay,
+                    beta_initializer=0.1)
+        with tf.variable_scope(scope, reuse=True):
+            beta = tf.get_variable('beta')
+        return (normed, tf.nn.relu(normed), beta)
+    bias = tf.get_variable(bias_name, [inputs.get_shape()[-1]],
+                           initializer=tf.constant_initializer(0.1))
+    with tf.variable_scope(bias_name + '_bn'):
+        normed = batch_norm_wrapper(inputs, is_training, decay)
+    return (normed, tf.nn.relu(normed + tf.cast(bias, dtype)), bias)
+
+
+def conv_batch_norm_relu(
+    inputs,
+    weight,
+    bias_name,
+    keep_prob,
+    is_training,
+    decay=0.999,
+    fused=False,
+    folded=False,
+    ):
+    """
+    A U-Net convolution followed by batch_norm_bias_relu.
+
+    With folded=True the batch norm is folded into the convolution: the
+    kernel is scaled by scale / sqrt(pop_var + epsilon) and the bias is
+    beta - pop_mean times that factor. It reads the variables of the fused
+    batch norm and always uses the population statistics, so once they are
+    frozen to constants the layer is one convolution and bias add.
+
+    :returns normed, activation, bias: see batch_norm_bias_relu
+    """
+
+    dtype = inputs.dtype.base_dtype
+    if not folded:
+        conv = conv2d(inputs, tf.cast(weight, dtype), keep_prob)
+        return batch_norm_bias_relu(conv, bias_name, is_training, decay,
+                                    fused)
+    with tf.variable_scope(bias_name + '_bn'):
+        (scale, beta, pop_mean, pop_var) = \
+            batch_norm_variables(weight.get_shape()[-1], 0.1)
+    factor = scale * tf.rsqrt(pop_var + BN_EPSILON)
+    normed = conv2d(inputs, tf.cast(weight * factor, dtype), keep_prob) \
+        + tf.cast(beta - pop_mean * factor, dtype)
+    return (normed, tf.nn.relu(normed), beta)
+
+
 def unet(
     x,
     is_training,
@@ -74,6 +206,11 @@ def unet(
     filter_size=3,
     pool_size=2,
     summaries=False,
+    device='/gpu:0',
+    dtype=tf.float32,
+    bn_decay=0.999,
+    fused_bn=False,
+    fold_bn=False,
     ):
     """
     Creates a new convolutional unet for the given parametrization.
@@ -87,9 +224,23 @@ def unet(
     :param filter_size: size of the convolution filter
     :param pool_size: size of the max pooling operation
     :param summaries: Flag if summaries should be created
+    :param device: device to build the network on, None leaves placement to
+        the session
+    :param dtype: compute dtype of the activations, e.g. tf.float16. The
+        variables stay float32 and the output is float32
+    :param bn_decay: decay of the batch norm population statistics per
+        batch. Use decay ** (1 / N) when accumulating gradients over N
+        micro-batches, so the statistics average over as many samples as
+        with one N times larger batch
+    :param fused_bn: use fused_batch_norm with the convolution biases
+        folded into beta. Checkpoints of the unfused network load with
+        restore_unet
+    :param fold_bn: fold the batch norms into the convolutions with their
+        population statistics, for inference. The variables are those of
+        fused_bn, see EXPORT.py
     """
 
-    with tf.device('/gpu:0'):
+    with tf.device(device):
         logging.info('Layers {layers}, features {features}, filter size {filter_size}x{filter_size}, pool size: {pool_size}x{pool_size}'.format(layers=layers,
                      features=features_root, filter_size=filter_size,
                      pool_size=pool_size))
@@ -98,12 +249,15 @@ def unet(
 
         nx = tf.shape(x)[1]
         ny = tf.shape(x)[2]
-        x_image = tf.reshape(x, tf.stack([-1, nx, ny, channels]))
+        dtype = tf.as_dtype(dtype)
+        x_image = tf.cast(tf.reshape(x, tf.stack([-1, nx, ny,
+                          channels])), dtype)
         in_node = x_image
         batch_size = tf.shape(x_image)[0]
 
         weights = []
         biases = []
+        others = []
         convs = []
         pools = OrderedDict()
         deconv = OrderedDict()
@@ -131,19 +285,27 @@ def unet(
                                  [filter_size, filter_size, features,
                                  features],
                                  initializer=tf.random_normal_initializer(stddev=stddev))
-            b1 = tf.get_variable('conv_%02d_b1' % (layer + 1),
-                                 [features],
-                                 initializer=tf.constant_initializer(0.1))
-            b2 = tf.get_variable('conv_%02d_b2' % (layer + 1),
-                                 [features],
-                                 initializer=tf.constant_initializer(0.1))
-            conv1 = conv2d(in_node, w1, keep_prob)
+            (conv1, tmp_h_conv, b1) = conv_batch_norm_relu(
+                in_node,
+                w1,
+                'conv_%02d_b1' % (layer + 1),
+                keep_prob,
+                is_training,
+                bn_decay,
+                fused_bn,
+                fold_bn,
+                )
             print(conv1.get_shape())
-            conv1 = batch_norm_wrapper(conv1, is_training)
-            tmp_h_conv = tf.nn.relu(conv1 + b1)
-            conv2 = conv2d(tmp_h_conv, w2, keep_prob)
-            conv2 = batch_norm_wrapper(conv2, is_training)
-            dw_h_convs[layer] = tf.nn.relu(conv2 + b2)
+            (conv2, dw_h_convs[layer], b2) = conv_batch_norm_relu(
+                tmp_h_conv,
+                w2,
+                'conv_%02d_b2' % (layer + 1),
+                keep_prob,
+                is_training,
+                bn_decay,
+                fused_bn,
+                fold_bn,
+                )
             weights.append((w1, w2))
             biases.append((b1, b2))
             convs.append((conv1, conv2))
@@ -170,7 +332,8 @@ def unet(
             bd = tf.get_variable('up_conv_%02d_bd' % (layer + 1),
                                  [features // 2],
                                  initializer=tf.constant_initializer(0.1))
-            h_deconv = tf.nn.relu(deconv2d(in_node, wd, pool_size) + bd)
+            h_deconv = tf.nn.relu(deconv2d(in_node, tf.cast(wd, dtype),
+                                  pool_size) + tf.cast(bd, dtype))
             h_deconv_concat = crop_and_concat(dw_h_convs[layer],
                     h_deconv)
             deconv[layer] = h_deconv_concat
@@ -190,26 +353,32 @@ def unet(
                                  initializer=tf.random_normal_initializer(stddev=stddev))
 
             # b1 = bias_variable([features//2])
-
-            b1 = tf.get_variable('up_conv_%02d_b1' % (layer + 1),
-                                 [features // 2],
-                                 initializer=tf.constant_initializer(0.1))
-
             # b2 = bias_variable([features//2])
 
-            b2 = tf.get_variable('up_conv_%02d_b2' % (layer + 1),
-                                 [features // 2],
-                                 initializer=tf.constant_initializer(0.1))
-
-            conv1 = conv2d(h_deconv_concat, w1, keep_prob)
-            conv1 = batch_norm_wrapper(conv1, is_training)
-            h_conv = tf.nn.relu(conv1 + b1)
-            conv2 = conv2d(h_conv, w2, keep_prob)
-            conv2 = batch_norm_wrapper(conv2, is_training)
-            in_node = tf.nn.relu(conv2 + b2)
+            (conv1, h_conv, b1) = conv_batch_norm_relu(
+                h_deconv_concat,
+                w1,
+                'up_conv_%02d_b1' % (layer + 1),
+                keep_prob,
+                is_training,
+                bn_decay,
+                fused_bn,
+                fold_bn,
+                )
+            (conv2, in_node, b2) = conv_batch_norm_relu(
+                h_conv,
+                w2,
+                'up_conv_%02d_b2' % (layer + 1),
+                keep_prob,
+                is_training,
+                bn_decay,
+                fused_bn,
+                fold_bn,
+                )
             up_h_convs[layer] = in_node
 
             weights.append((w1, w2))
+            others += [wd, bd]
             biases.append((b1, b2))
             convs.append((conv1, conv2))
 
@@ -227,11 +396,16 @@ def unet(
 
         bias = tf.get_variable('bias', [n_class],
                                initializer=tf.constant_initializer(0.1))
-        conv = conv2d(in_node, weight, tf.constant(1.0))
+        # no dropout on the output map; a Python 1 keeps tf.nn.dropout out
+        # of the graph
+
+        conv = conv2d(in_node, tf.cast(weight, dtype), 1)
+        others += [weight, bias]
 
             # conv = batch_norm_wrapper(conv, is_training)
 
-        output_map = tf.nn.relu(conv + bias)
+        output_map = tf.cast(tf.nn.relu(conv + tf.cast(bias, dtype)),
+                             tf.float32)
 
         # output_map = tf.add(output_map, x_image)
 
@@ -269,13 +443,158 @@ def unet(
             variables.append(b1)
             variables.append(b2)
 
+        # the deconvolutions, the output map and the batch norms
+
+        variables += others
+        scope = tf.get_variable_scope().name
+        names = set(var.op.name for var in variables)
+        variables += [var for var in
+                      tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES,
+                      scope) if '_bn/' in var.op.name and var.op.name
+                      not in names]
+
         # return output_map, variables, int(in_size - size)
 
-            return (output_map, variables)
+        return (output_map, variables)
+
+
+# batch norm variables older checkpoints do not hold; restore_unet leaves
+# them at their initial values
+
+OPTIONAL_BN_VARIABLES = ('_bn/scale', '_bn/pop_mean', '_bn/pop_var')
+
+# the only variables a checkpoint written before the batch norms were named
+# must hold: the training files saved the convolution kernels and, as unet
+# returned from inside its bias loop, the first pair of biases
+
+LEGACY_REQUIRED_VARIABLES = ('_w1', '_w2')
+BN_VARIABLE_PATTERN = re.compile(r'_bn/(scale|beta|pop_mean|pop_var)$')
+
 
+def legacy_batch_norm_names(saved, variables):
+    """
+    Maps the batch norm variables of a U-Net onto a checkpoint written
+    before they were named. batch_norm_wrapper then created them with
+    tf.Variable as `<scope>/Variable`, `Variable_1`, ... in the order unet
+    builds them: scale, beta, pop_mean and pop_var of every batch norm.
+    A test graph built with reuse got a second set after them, the first
+    set is the trained one.
+
+    :param saved: checkpoint variable names
+    :param variables: every global variable of the graph, in creation order
+
+    :returns aliases: {variable name: checkpoint name}, empty if the
+        checkpoint has named batch norms
+    """
+
+    if any('_bn/' in name for name in saved):
+        return {}
+    by_scope = OrderedDict()
+    for var in variables:
+        name = var.op.name
+        if BN_VARIABLE_PATTERN.search(name):
+            scope = name[:name.rindex('_bn/')].rpartition('/')[0]
+            by_scope.setdefault(scope, []).append(name)
+    aliases = {}
+    for (scope, names) in by_scope.items():
+        pattern = re.compile(re.escape((scope + '/' if scope else ''))
+                             + r'Variable(?:_(\d+))?$')
+        legacy = sorted((int(match.group(1) or 0), match.group(0))
+                        for match in map(pattern.match, saved) if match)
+        aliases.update(zip(names, [name for (_, name) in legacy]))
+    return aliases
+
+
+def restore_unet(sess, ckpt_path, variables=None):
+    """
+    Restores U-Net variables from a checkpoint by name, across the fused_bn
+    setting: in a fused network `<bias>_bn/beta` loads the bias `<bias>`
+    plus the unfused beta, in an unfused one the bias loads 0 from a fused
+    checkpoint and beta carries it. Only the OPTIONAL_BN_VARIABLES may be
+    missing from the checkpoint, they keep their current value.
+
+    Checkpoints written before the batch norms were named load their
+    `Variable_N` batch norms through legacy_batch_norm_names. They only
+    have to hold the LEGACY_REQUIRED_VARIABLES; the biases, deconvolutions
+    and output map they lack keep their initial values, as they did when
+    those checkpoints were written, and are listed.
+
+    :param variables: variables to restore, all global variables of
+        sess.graph if None
+
+    :returns restored: names of the variables loaded
+    :raises tf.errors.NotFoundError: if any other variable is missing or
+        nothing was restored
+    """
+
+    reader = tf.train.NewCheckpointReader(ckpt_path)
+    saved = reader.get_variable_to_shape_map()
+    graph_variables = \
+        sess.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+    if variables is None:
+        variables = graph_variables
+    present = set(var.op.name for var in graph_variables)
+    legacy = not any('_bn/' in name for name in saved)
+    aliases = legacy_batch_norm_names(saved, graph_variables)
+    restored = []
+    missing = []
+    initial = []
+    for var in variables:
+        name = var.op.name
+        parts = [name]
+        if name.endswith('_bn/beta') and name[:-len('_bn/beta')] \
+            not in present:
+            parts.append(name[:-len('_bn/beta')])
+        found = [aliases.get(part, part) for part in parts
+                 if aliases.get(part, part) in saved]
+        if found:
+            value = sum(reader.get_tensor(part) for part in found)
+            if legacy and len(found) < len(parts):
+
+                # a fused beta also carries the part the checkpoint lacks
+                # at its initial value: 0.1 for a bias, 0 for a beta
+
+                if parts[1] not in saved:
+                    value = value + sess.run(var.initial_value)
+                initial += [part for part in parts
+                            if aliases.get(part, part) not in saved]
+        elif name + '_bn/beta' in saved and name + '_bn/beta' in present:
+            value = np.zeros(var.get_shape().as_list(), np.float32)
+        else:
+            if legacy and not name.endswith(LEGACY_REQUIRED_VARIABLES):
+                initial.append(name)
+            elif not name.endswith(OPTIONAL_BN_VARIABLES):
+                missing.append(name)
+            continue
+        if tuple(value.shape) != tuple(var.get_shape().as_list()):
+            raise ValueError('%s has shape %s in %s, expected %s'
+                             % (name, value.shape, ckpt_path,
+                             var.get_shape()))
+        var.load(value, sess)
+        restored.append(name)
+    if missing or not restored:
+        raise tf.errors.NotFoundError(None, None,
+                '%s lacks %d of %d variables: %s' % (ckpt_path,
+                len(missing), len(variables), ', '.join(missing)))
+    if initial:
+        print('%s predates the named batch norms, initial values kept for: %s'
+               % (ckpt_path, ', '.join(initial)))
+    return restored
+
+
+def model(input_tensor, device='/gpu:0', dtype=tf.float32):
+    """
+    VDSR: 20 3x3 convolutions with a global residual connection.
+
+    :param input_tensor: input tensor, shape [?,nx,ny,1]
+    :param device: device to build the network on, None leaves placement to
+        the session
+    :param dtype: compute dtype of the activations, e.g. tf.float16. The
+        variables stay float32 and the output is float32
+    """
 
-def model(input_tensor):
-    with tf.device('/gpu:0'):
+    with tf.device(device):
+        dtype = tf.as_dtype(dtype)
         weights = []
         tensor = None
 
@@ -288,9 +607,10 @@ def model(input_tensor):
                                     initializer=tf.constant_initializer(0))
         weights.append(conv_00_w)
         weights.append(conv_00_b)
-        tensor = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(input_tensor,
-                            conv_00_w, strides=[1, 1, 1, 1],
-                            padding='SAME'), conv_00_b))
+        tensor = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(tf.cast(input_tensor,
+                            dtype), tf.cast(conv_00_w, dtype), strides=[1,
+                            1, 1, 1], padding='SAME'), tf.cast(conv_00_b,
+                            dtype)))
 
         for i in range(18):
 
@@ -305,8 +625,9 @@ def model(input_tensor):
             weights.append(conv_w)
             weights.append(conv_b)
             tensor = tf.nn.relu(tf.nn.bias_add(tf.nn.conv2d(tensor,
-                                conv_w, strides=[1, 1, 1, 1],
-                                padding='SAME'), conv_b))
+                                tf.cast(conv_w, dtype), strides=[1, 1, 1,
+                                1], padding='SAME'), tf.cast(conv_b,
+                                dtype)))
 
         # conv_w = tf.get_variable("conv_19_w", [3,3,64,1], initializer=tf.contrib.layers.xavier_initializer())
 
@@ -317,9 +638,9 @@ def model(input_tensor):
                                  initializer=tf.constant_initializer(0))
         weights.append(conv_w)
         weights.append(conv_b)
-        tensor = tf.nn.bias_add(tf.nn.conv2d(tensor, conv_w,
-                                strides=[1, 1, 1, 1], padding='SAME'),
-                                conv_b)
+        tensor = tf.nn.bias_add(tf.nn.conv2d(tensor, tf.cast(conv_w,
+                                dtype), strides=[1, 1, 1, 1],
+                                padding='SAME'), tf.cast(conv_b, dtype))
 
-        tensor = tf.add(tensor, input_tensor)
+        tensor = tf.add(tf.cast(tensor, tf.float32), input_tensor)
         return (tensor, weights)
@@ -1,8 +1,8 @@
 import tensorflow as tf
 import numpy as np
 
-def model_factorized(input_tensor):
-	with tf.device("/gpu:0"):
+def model_factorized(input_tensor, device="/gpu:0"):
+	with tf.device(device):
 		weights = []
 		tensor = None
 
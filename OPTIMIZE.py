@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import tensorflow as tf
+
+
+class DynamicLossScale(object):
+    """
+    Loss scale of float16 training that follows the gradients. A step whose
+    gradients are not all finite is skipped and halves the scale, and every
+    `growth_steps` finite steps in a row double it again. The scale and its
+    step count are global variables, so the training state keeps them.
+
+    :param initial: loss scale of the first step
+    :param growth_steps: finite steps before the scale doubles
+    :param min_scale: the scale is not lowered below this
+    """
+
+    def __init__(
+        self,
+        initial=2.0 ** 15,
+        growth_steps=2000,
+        min_scale=1.0,
+        ):
+        self.growth_steps = growth_steps
+        self.min_scale = min_scale
+        self.scale = tf.Variable(float(initial), trainable=False,
+                                 name='loss_scale')
+        self.good_steps = tf.Variable(0, trainable=False,
+                dtype=tf.int32, name='loss_scale_good_steps')
+
+    def apply(
+        self,
+        optimizer,
+        gvs,
+        global_step=None,
+        transform=None,
+        ):
+        """
+        Applies gvs with optimizer if every gradient is finite, then updates
+        the scale.
+
+        :param transform: optional function of gvs run on the finite
+            gradients only, e.g. the gradient clipping
+
+        :returns op: update op
+        """
+        finite = tf.reduce_all([tf.reduce_all(tf.is_finite(grad))
+                               for (grad, _) in gvs])
+
+        def update():
+            applied = (gvs if transform is None else transform(gvs))
+            with tf.control_dependencies([optimizer.apply_gradients(applied,
+                    global_step=global_step)]):
+                return tf.constant(True)
+
+        updated = tf.cond(finite, update, lambda : tf.constant(False))
+        good_steps = tf.where(finite, self.good_steps + 1, 0)
+        grow = good_steps >= self.growth_steps
+        scale = tf.where(finite, tf.where(grow, self.scale * 2,
+                         self.scale), tf.maximum(self.scale / 2,
+                         self.min_scale))
+        with tf.control_dependencies([updated]):
+            return tf.group(self.scale.assign(scale),
+                            self.good_steps.assign(tf.where(grow, 0,
+                            good_steps)))
+
+
+def make_loss_scale(loss_scale):
+    """
+    DynamicLossScale starting at loss_scale, or None if loss_scale is None
+    or 1. A DynamicLossScale is returned as it is.
+    """
+    if loss_scale in (None, 1) or isinstance(loss_scale,
+            DynamicLossScale):
+        return loss_scale
+    return DynamicLossScale(loss_scale)
+
+
+def compute_gradients(loss, var_list=None, loss_scale=None):
+    """
+    Gradients of loss, optionally computed on a scaled loss so that small
+    float16 gradients do not flush to zero. The returned gradients are
+    unscaled again.
+
+    :param loss: float32 scalar loss
+    :param var_list: variables to differentiate, defaults to the trainable
+        variables
+    :param loss_scale: constant loss scale or DynamicLossScale, None or 1
+        disables scaling
+
+    :returns gvs: list of (gradient, variable)
+    """
+    if var_list is None:
+        var_list = tf.trainable_variables()
+    if loss_scale in (None, 1):
+        return list(zip(tf.gradients(loss, var_list), var_list))
+    if isinstance(loss_scale, DynamicLossScale):
+        loss_scale = loss_scale.scale.read_value()
+    grads = tf.gradients(loss * loss_scale, var_list)
+    return [((None if grad is None else grad / loss_scale), var)
+            for (grad, var) in zip(grads, var_list)]
+
+
+def apply_gradients(
+    gvs,
+    global_step,
+    learning_rate,
+    use_adam=True,
+    clip_norm=0.01,
+    loss_scale=None,
+    ):
+    """
+    Adam, or momentum 0.9 with every gradient clipped to clip_norm, update
+    of gvs. With a DynamicLossScale a step with gradients that are not all
+    finite is skipped instead.
+
+    :param loss_scale: DynamicLossScale the gradients were computed with,
+        or None
+
+    :returns op: update op
+    """
+    if use_adam:
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+        transform = None
+    else:
+        optimizer = tf.train.MomentumOptimizer(learning_rate, 0.9)
+        transform = lambda gvs: [(tf.clip_by_norm(grad, clip_norm), var)
+                                 for (grad, var) in gvs]
+    if loss_scale is not None:
+        return loss_scale.apply(optimizer, gvs, global_step, transform)
+    if transform is not None:
+        gvs = transform(gvs)
+    return optimizer.apply_gradients(gvs, global_step=global_step)
+
+
+def minimize(
+    loss,
+    global_step,
+    learning_rate,
+    use_adam=True,
+    clip_norm=0.01,
+    loss_scale=None,
+    ):
+    """
+    Training op of the training files: Adam, or momentum 0.9 with every
+    gradient clipped to clip_norm.
+
+    :param loss: float32 scalar loss
+    :param global_step: step counter incremented by the op
+    :param learning_rate: learning rate tensor or float
+    :param use_adam: Adam instead of clipped momentum
+    :param clip_norm: per gradient norm limit of the momentum optimizer
+    :param loss_scale: initial loss scale of float16 training, see
+        DynamicLossScale
+
+    :returns opt: training op
+    """
+    loss_scale = make_loss_scale(loss_scale)
+    gvs = [(grad, var) for (grad, var) in compute_gradients(loss,
+           loss_scale=loss_scale) if grad is not None]
+    return apply_gradients(gvs, global_step, learning_rate, use_adam,
+                           clip_norm, loss_scale)
+
+
+def accumulating_minimize(
+    loss,
+    global_step,
+    learning_rate,
+    accumulate_steps=1,
+    use_adam=True,
+    clip_norm=0.01,
+    loss_scale=None,
+    ):
+    """
+    Training ops that sum the gradients of `accumulate_steps` micro-batches
+    in float32 buffers and apply their mean in one Adam or clipped momentum
+    update, for effective batches that do not fit in memory at once.
+
+    Run `accumulate` on every micro-batch but the last of a group and
+    `apply` on the last one; `apply` also adds the last gradients and clears
+    the buffers. An overflow in any micro-batch skips the whole update. With
+    accumulate_steps=1 both are the plain minimize op.
+
+    :param accumulate_steps: micro-batches per update. The other parameters
+        are those of minimize
+
+    :returns accumulate, apply: training ops
+    """
+    if accumulate_steps <= 1:
+        opt = minimize(loss, global_step, learning_rate, use_adam,
+                       clip_norm, loss_scale)
+        return (opt, opt)
+
+    loss_scale = make_loss_scale(loss_scale)
+    gvs = [(grad, var) for (grad, var) in compute_gradients(loss,
+           loss_scale=loss_scale) if grad is not None]
+    buffers = [tf.Variable(tf.zeros(var.get_shape(), tf.float32),
+               trainable=False, name='accumulated_gradient')
+               for (_, var) in gvs]
+    accumulate = tf.group(*[buf.assign_add(grad) for (buf, (grad, _))
+                          in zip(buffers, gvs)])
+    with tf.control_dependencies([accumulate]):
+        mean_gvs = [(buf.read_value() / accumulate_steps, var)
+                    for (buf, (_, var)) in zip(buffers, gvs)]
+    update = apply_gradients(mean_gvs, global_step, learning_rate,
+                             use_adam, clip_norm, loss_scale)
+    with tf.control_dependencies([update]):
+        apply = tf.group(*[buf.assign(tf.zeros_like(buf)) for buf in
+                         buffers])
+    return (accumulate, apply)
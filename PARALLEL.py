@@ -0,0 +1,441 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import multiprocessing
+import numpy as np
+
+ENV_RANK = 'PARALLEL_RANK'
+ENV_ADDRESSES = 'PARALLEL_ADDRESSES'
+
+
+def parse_addresses(value):
+    """
+    Parses 'host:port,host:port,...' into [(host, port), ...].
+    """
+    addresses = []
+    for item in value.split(','):
+        (host, port) = item.rsplit(':', 1)
+        addresses.append((host, int(port)))
+    return addresses
+
+
+def shard(train_list, rank, world_size):
+    """
+    Disjoint, equally long part of train_list for one worker, so every
+    worker runs the same number of steps per epoch.
+    """
+    usable = len(train_list) // world_size * world_size
+    return train_list[rank:usable:world_size]
+
+
+class RingAllReduce(object):
+    """
+    Sums float32 arrays across processes with a ring all-reduce over TCP
+    sockets: a reduce-scatter followed by an all-gather, each of
+    world_size - 1 steps in which every worker sends one chunk to the next
+    worker while it receives one from the previous one. Every worker sends
+    2 * (world_size - 1) / world_size times the array size per call,
+    independent of the number of workers.
+
+    :param rank: index of this worker in addresses
+    :param addresses: (host, port) every worker listens on, in ring order
+    :param timeout: seconds to wait for the neighbours to come up
+    """
+
+    def __init__(self, rank, addresses, timeout=120):
+        self.rank = rank
+        self.world_size = len(addresses)
+        self.next_sock = None
+        self.prev_sock = None
+        if self.world_size == 1:
+            return
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', addresses[rank][1]))
+        listener.listen(1)
+
+        # connect to the next worker, which may still be starting up
+
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.next_sock = \
+                    socket.create_connection(addresses[(rank + 1)
+                        % self.world_size], timeout=timeout)
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+        listener.settimeout(timeout)
+        (self.prev_sock, _) = listener.accept()
+        listener.close()
+        for sock in (self.next_sock, self.prev_sock):
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @classmethod
+    def from_environment(cls):
+        """
+        Ring described by PARALLEL_RANK / PARALLEL_ADDRESSES, as set by
+        `python PARALLEL.py launch`, or None outside a parallel run.
+        """
+        if ENV_ADDRESSES not in os.environ:
+            return None
+        return cls(int(os.environ[ENV_RANK]),
+                   parse_addresses(os.environ[ENV_ADDRESSES]))
+
+    def _exchange(self, send, recv):
+        sender = threading.Thread(target=self.next_sock.sendall,
+                                  args=(memoryview(send.view(np.uint8)),
+                                  ))
+        sender.start()
+        view = memoryview(recv.view(np.uint8))
+        received = 0
+        while received < len(view):
+            n = self.prev_sock.recv_into(view[received:])
+            if n == 0:
+                raise IOError('worker %d lost its ring neighbour'
+                              % self.rank)
+            received += n
+        sender.join()
+
+    def allreduce(self, array):
+        """
+        Replaces a contiguous 1-D float array by its sum over all workers.
+        """
+        if self.world_size == 1:
+            return array
+        (rank, size) = (self.rank, self.world_size)
+        chunks = np.array_split(array, size)
+        buf = np.empty(len(chunks[0]), dtype=array.dtype)
+        for step in range(size - 1):
+            recv_chunk = chunks[(rank - step - 1) % size]
+            self._exchange(chunks[(rank - step) % size],
+                           buf[:len(recv_chunk)])
+            recv_chunk += buf[:len(recv_chunk)]
+        for step in range(size - 1):
+            self._exchange(chunks[(rank - step + 1) % size],
+                           chunks[(rank - step) % size])
+        return array
+
+    def barrier(self):
+        self.allreduce(np.zeros(self.world_size, dtype=np.float32))
+
+    def broadcast_scalar(self, value):
+        """
+        The value of worker 0 on every worker, e.g. its test PSNR.
+        """
+        array = np.zeros(self.world_size, dtype=np.float64)
+        if self.rank == 0:
+            array[0] = value
+        return float(self.allreduce(array)[0])
+
+    def broadcast_object(self, value):
+        """
+        The JSON-serialisable value of worker 0 on every worker, e.g. the
+        training state sidecar only worker 0 has read.
+        """
+        if self.world_size == 1:
+            return value
+        data = (json.dumps(value).encode('utf-8') if self.rank
+                == 0 else b'')
+        array = np.zeros(int(self.broadcast_scalar(len(data))),
+                         dtype=np.float64)
+        if self.rank == 0:
+            array[:] = np.frombuffer(data, dtype=np.uint8)
+        data = self.allreduce(array).astype(np.uint8).tobytes()
+        return json.loads(data.decode('utf-8'))
+
+    def close(self):
+        for sock in (self.next_sock, self.prev_sock):
+            if sock is not None:
+                sock.close()
+
+
+class DataParallel(object):
+    """
+    Synchronous data-parallel training: every worker computes the gradients
+    of its own batch, the flat gradient vector is averaged over the ring and
+    every worker applies the same Adam or clipped momentum update.
+
+    :param ring: RingAllReduce
+    :param loss: float32 scalar loss
+    :param global_step: step counter incremented by the update
+    :param learning_rate: learning rate tensor or float
+    :param use_adam: Adam instead of clipped momentum
+    :param clip_norm: per gradient norm limit of the momentum optimizer
+    :param loss_scale: initial loss scale of float16 training, see
+        OPTIMIZE.DynamicLossScale. Every worker sees the same averaged
+        gradients, so all of them skip the same steps
+    """
+
+    def __init__(
+        self,
+        ring,
+        loss,
+        global_step,
+        learning_rate,
+        use_adam=True,
+        clip_norm=0.01,
+        loss_scale=None,
+        ):
+        import tensorflow as tf
+        from OPTIMIZE import apply_gradients, compute_gradients, \
+            make_loss_scale
+
+        self.ring = ring
+        loss_scale = make_loss_scale(loss_scale)
+        gvs = [(grad, var) for (grad, var) in compute_gradients(loss,
+               loss_scale=loss_scale) if grad is not None]
+        self.variables = [var for (_, var) in gvs]
+        self.flat_grad = tf.concat([tf.reshape(grad, [-1]) for (grad,
+                                   _) in gvs], 0)
+        self.grad_input = tf.placeholder(tf.float32,
+                shape=self.flat_grad.get_shape())
+        sizes = [int(np.prod(var.get_shape().as_list())) for var in
+                 self.variables]
+        mean_gvs = [(tf.reshape(grad, var.get_shape()), var) for (grad,
+                    var) in zip(tf.split(self.grad_input, sizes),
+                    self.variables)]
+        self.apply = apply_gradients(mean_gvs, global_step,
+                learning_rate, use_adam, clip_norm, loss_scale)
+
+    @property
+    def is_chief(self):
+        return self.ring.rank == 0
+
+    def broadcast(self, sess, variables=None):
+        """
+        Copies the values of worker 0 to every worker, e.g. after the
+        random initialisation, or every variable of the training state it
+        resumed. The values travel as float64, so integer variables such as
+        global_step arrive exactly.
+        """
+        if variables is None:
+            variables = self.variables
+        values = sess.run(variables)
+        flat = np.concatenate([np.ravel(value).astype(np.float64)
+                              for value in values])
+        if not self.is_chief:
+            flat[:] = 0
+        self.ring.allreduce(flat)
+        offset = 0
+        for (var, value) in zip(variables, values):
+            chunk = flat[offset:offset + value.size]
+            var.load(chunk.reshape(value.shape).astype(value.dtype), sess)
+            offset += value.size
+
+    def step(self, sess, flat_grad):
+        """
+        Averages the fetched flat_grad over all workers and applies it.
+        """
+        flat_grad = np.ascontiguousarray(flat_grad, dtype=np.float32)
+        self.ring.allreduce(flat_grad)
+        flat_grad /= self.ring.world_size
+        sess.run(self.apply, feed_dict={self.grad_input: flat_grad})
+
+
+def start_workers(
+    command,
+    nproc,
+    hosts=('127.0.0.1', ),
+    node_rank=0,
+    port=29500,
+    pin=False,
+    stdout=None,
+    ):
+    """
+    Starts the nproc local workers of one node. Every node of a multi-host
+    run calls this with the same hosts and its own node_rank; ranks and
+    ports follow node_rank * nproc + local rank.
+
+    :param command: argv of one worker, e.g. ['VDSR.py', '--store_path', ...]
+    :param pin: give every local worker its own block of cores, passed on
+        as --cpus / --intra_op_threads
+    :param stdout: stdout of the workers, e.g. subprocess.PIPE
+
+    :returns workers: subprocess.Popen of every local worker
+    """
+    addresses = ['%s:%d' % (host, port + i) for host in hosts
+                 for i in range(nproc)]
+    cores = multiprocessing.cpu_count()
+    per_worker = max(1, cores // nproc)
+    workers = []
+    for local_rank in range(nproc):
+        env = dict(os.environ)
+        env[ENV_RANK] = str(node_rank * nproc + local_rank)
+        env[ENV_ADDRESSES] = ','.join(addresses)
+        argv = [sys.executable] + list(command)
+        if pin:
+            first = local_rank * per_worker % cores
+            argv += ['--cpus', '%d-%d' % (first, first + per_worker - 1),
+                     '--intra_op_threads', str(per_worker)]
+        workers.append(subprocess.Popen(argv, env=env, stdout=stdout))
+    return workers
+
+
+def launch(*args, **kwargs):
+    """
+    Starts the local workers like start_workers and waits for them.
+
+    :returns returncodes: exit status of the local workers
+    """
+    workers = start_workers(*args, **kwargs)
+    try:
+        return [worker.wait() for worker in workers]
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+
+
+def benchmark_worker(args):
+    """
+    One worker of the scaling benchmark: data-parallel training steps on
+    random data. Worker 0 prints its samples/sec as JSON.
+    """
+    import tensorflow as tf
+    from functools import partial
+    from MODEL import model, unet
+    from SESSION import make_session, model_device, session_args
+
+    ring = RingAllReduce.from_environment()
+    build_fn = {'vdsr': model, 'unet': partial(unet,
+                is_training=True)}[args.model]
+    shape = (args.batch_size, args.img_size, args.img_size, 1)
+    train_input = tf.placeholder(tf.float32, shape=shape)
+    train_gt = tf.placeholder(tf.float32, shape=shape)
+    with tf.variable_scope('foo'):
+        (train_output, _) = build_fn(train_input,
+                                     device=model_device(args.cpu))
+    loss = tf.reduce_mean(tf.nn.l2_loss(train_output - train_gt))
+    global_step = tf.Variable(0, trainable=False)
+    parallel = DataParallel(ring, loss, global_step, 0.0001)
+    rng = np.random.RandomState(ring.rank)
+    feed_dict = {train_input: rng.rand(*shape).astype(np.float32),
+                 train_gt: rng.rand(*shape).astype(np.float32)}
+    with make_session(**session_args(args)) as sess:
+        sess.run(tf.global_variables_initializer())
+        parallel.broadcast(sess)
+        for step in range(args.warmup + args.steps):
+            if step == args.warmup:
+                ring.barrier()
+                start = time.time()
+            parallel.step(sess, sess.run(parallel.flat_grad,
+                          feed_dict=feed_dict))
+        ring.barrier()
+        elapsed = time.time() - start
+    if parallel.is_chief:
+        print(json.dumps({'workers': ring.world_size,
+              'samples_per_sec': args.steps * args.batch_size
+              * ring.world_size / elapsed}))
+    ring.close()
+
+
+def benchmark_scaling(
+    worker_counts,
+    model='vdsr',
+    batch_size=4,
+    img_size=128,
+    steps=20,
+    port=29500,
+    ):
+    """
+    Runs the benchmark worker at every worker count on this host, each
+    worker pinned to its own cores.
+
+    :returns results: list of {'workers', 'samples_per_sec', 'speedup',
+        'efficiency'}
+    """
+    results = []
+    for workers in worker_counts:
+        command = [
+            os.path.abspath(__file__),
+            'worker',
+            '--model',
+            model,
+            '--batch_size',
+            str(batch_size),
+            '--img_size',
+            str(img_size),
+            '--steps',
+            str(steps),
+            '--cpu',
+            ]
+        procs = start_workers(command, workers, port=port, pin=True,
+                              stdout=subprocess.PIPE)
+        outputs = [proc.communicate()[0] for proc in procs]
+        if any(proc.returncode for proc in procs):
+            raise RuntimeError('benchmark with %d workers failed'
+                               % workers)
+        results.append(json.loads(outputs[0].decode('utf-8'
+                       ).strip().splitlines()[-1]))
+    base = results[0]['samples_per_sec'] / results[0]['workers']
+    for result in results:
+        result['speedup'] = result['samples_per_sec'] / base
+        result['efficiency'] = result['speedup'] / result['workers']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel training over a ring all-reduce.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    launch_parser = subparsers.add_parser('launch',
+            help='start the workers of this node, e.g. launch --nproc 4 VDSR.py --store_path ...')
+    launch_parser.add_argument('--nproc', type=int, required=True,
+                               help='workers on this node')
+    launch_parser.add_argument('--hosts', default='127.0.0.1',
+                               help='comma separated hosts, one per node')
+    launch_parser.add_argument('--node_rank', type=int, default=0)
+    launch_parser.add_argument('--port', type=int, default=29500)
+    launch_parser.add_argument('--pin', action='store_true',
+                               help='pin every worker to its own cores')
+    launch_parser.add_argument('script')
+    launch_parser.add_argument('script_args', nargs=argparse.REMAINDER)
+
+    bench_parser = subparsers.add_parser('benchmark',
+            help='scaling efficiency at several worker counts on this host')
+    bench_parser.add_argument('--workers', default='1,2,4,8')
+    bench_parser.add_argument('--port', type=int, default=29500)
+
+    worker_parser = subparsers.add_parser('worker')
+    for sub in (bench_parser, worker_parser):
+        sub.add_argument('--model', choices=['vdsr', 'unet'],
+                         default='vdsr')
+        sub.add_argument('--batch_size', type=int, default=4)
+        sub.add_argument('--img_size', type=int, default=128)
+        sub.add_argument('--steps', type=int, default=20)
+    worker_parser.add_argument('--warmup', type=int, default=3)
+    from SESSION import add_session_args
+    add_session_args(worker_parser)
+    args = parser.parse_args()
+
+    if args.command == 'launch':
+        codes = launch([args.script] + args.script_args, args.nproc,
+                       args.hosts.split(','), args.node_rank, args.port,
+                       args.pin)
+        sys.exit(max(codes))
+    elif args.command == 'worker':
+        benchmark_worker(args)
+    else:
+        results = benchmark_scaling([int(n) for n in
+                                    args.workers.split(',')], args.model,
+                                    args.batch_size, args.img_size,
+                                    args.steps, args.port)
+        for result in results:
+            print('%d workers: %8.2f samples/sec\t speedup %.2f\t efficiency %.0f%%'
+                   % (result['workers'], result['samples_per_sec'],
+                  result['speedup'], 100 * result['efficiency']))
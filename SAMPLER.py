@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import time
+import argparse
+import numpy as np
+
+
+class EpochSampler(object):
+    """
+    Draws the sample indices of every epoch: a fresh permutation of the
+    dataset per epoch, or a weighted sample with replacement when weights
+    are given. The draw is a single vectorised numpy call per epoch and only
+    depends on (seed, epoch), so a resumed run sees the same batches.
+
+    :param size: number of samples, e.g. len(train_list)
+    :param batch_size: samples per batch
+    :param steps_per_epoch: fixed number of batches per epoch. Epochs longer
+        than the dataset chain several permutations
+    :param epoch_fraction: share of the dataset one epoch covers when
+        steps_per_epoch is None
+    :param weights: optional sampling weight of every sample
+    :param drop_last: drop the last batch of an epoch if it is short,
+        otherwise it is yielded with fewer samples
+    :param seed: seed of the draws, None picks one
+    """
+
+    def __init__(
+        self,
+        size,
+        batch_size,
+        steps_per_epoch=None,
+        epoch_fraction=1.0,
+        weights=None,
+        drop_last=True,
+        seed=None,
+        ):
+        self.size = size
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = (np.random.randint(2 ** 31) if seed is None else seed)
+        self.cdf = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            if weights.shape != (size, ) or np.any(weights < 0) \
+                or not weights.sum() > 0:
+                raise ValueError('Expected %d non-negative sample weights, got shape %s'
+                                  % (size, weights.shape))
+
+            # inverse transform sampling against the cumulative weights
+
+            self.cdf = np.cumsum(weights)
+
+        if steps_per_epoch:
+            self.samples_per_epoch = steps_per_epoch * batch_size
+            self.steps_per_epoch = steps_per_epoch
+        else:
+            self.samples_per_epoch = int(round(size * epoch_fraction))
+            self.steps_per_epoch = (self.samples_per_epoch // batch_size
+                                    if drop_last else
+                                    -(-self.samples_per_epoch
+                                    // batch_size))
+            if drop_last:
+                self.samples_per_epoch = self.steps_per_epoch \
+                    * batch_size
+        if self.steps_per_epoch <= 0:
+            raise ValueError('%d samples do not fill a batch of %d'
+                             % (self.samples_per_epoch, batch_size))
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def epoch_indices(self, epoch):
+        """
+        :returns indices: int64 array of the samples_per_epoch indices of
+            the epoch, in batch order
+        """
+        rng = np.random.RandomState([self.seed, epoch])
+        n = self.samples_per_epoch
+        if self.cdf is not None:
+
+            # sorted draws make the search a near sequential walk over the
+            # cdf; the shuffle restores a random order
+
+            draws = np.sort(rng.random_sample(n)) * self.cdf[-1]
+            indices = np.searchsorted(self.cdf, draws, side='right')
+            rng.shuffle(indices)
+            return indices
+        passes = -(-n // self.size)
+        if passes == 1:
+            return rng.permutation(self.size)[:n]
+        return np.concatenate([rng.permutation(self.size) for _ in
+                              range(passes)])[:n]
+
+    def batches(self, epoch, first_step=0):
+        """
+        Yields the index array of every batch of the epoch, starting at
+        first_step.
+        """
+        indices = self.epoch_indices(epoch)
+        for step in range(first_step, self.steps_per_epoch):
+            yield indices[step * self.batch_size:(step + 1)
+                          * self.batch_size]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the per-epoch draw of the sampler.')
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--weighted', action='store_true')
+    args = parser.parse_args()
+
+    weights = (np.random.rand(args.size) if args.weighted else None)
+    sampler = EpochSampler(args.size, args.batch_size, weights=weights)
+    start = time.time()
+    indices = sampler.epoch_indices(0)
+    print('%d samples, %d steps per epoch: draw %.3fs'
+          % (args.size, len(sampler), time.time() - start))
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import math
+
+SCHEDULES = ('constant', 'step', 'cosine', 'plateau')
+
+
+class _Stateful(object):
+
+    def get_state(self):
+        """
+        JSON-serialisable state, e.g. for a training state checkpoint.
+        """
+        return dict(self.__dict__)
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+
+class StepSchedule(_Stateful):
+    """
+    base_lr * rate ** (epoch // step_size), the decay the training files
+    define BASE_LR, LR_RATE and LR_STEP_SIZE for.
+    """
+
+    def __init__(self, base_lr, rate=0.1, step_size=100):
+        self.base_lr = base_lr
+        self.rate = rate
+        self.step_size = step_size
+
+    def __call__(self, epoch):
+        return self.base_lr * self.rate ** (epoch // self.step_size)
+
+    def update(self, metric):
+        pass
+
+
+class CosineSchedule(_Stateful):
+    """
+    Cosine decay from base_lr at epoch 0 to min_lr at max_epoch.
+    """
+
+    def __init__(self, base_lr, max_epoch, min_lr=0.0):
+        self.base_lr = base_lr
+        self.max_epoch = max_epoch
+        self.min_lr = min_lr
+
+    def __call__(self, epoch):
+        progress = min(1.0, epoch / max(1, self.max_epoch))
+        return self.min_lr + 0.5 * (self.base_lr - self.min_lr) * (1
+                + math.cos(math.pi * progress))
+
+    def update(self, metric):
+        pass
+
+
+class PlateauSchedule(_Stateful):
+    """
+    Multiplies the learning rate by `rate` whenever the validation metric,
+    e.g. the test PSNR, has not improved by min_delta for `patience` epochs.
+
+    :param min_lr: the learning rate is not lowered below this
+    """
+
+    def __init__(
+        self,
+        base_lr,
+        rate=0.1,
+        patience=5,
+        min_delta=0.01,
+        min_lr=1e-07,
+        ):
+        self.lr = base_lr
+        self.rate = rate
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_lr = min_lr
+        self.best = None
+        self.bad_epochs = 0
+
+    def __call__(self, epoch):
+        return self.lr
+
+    def update(self, metric):
+        """
+        Records the metric of the epoch that just ended.
+        """
+        metric = float(metric)
+        if self.best is None or metric > self.best + self.min_delta:
+            self.best = metric
+            self.bad_epochs = 0
+            return
+        self.bad_epochs += 1
+        if self.bad_epochs >= self.patience and self.lr > self.min_lr:
+            self.lr = max(self.min_lr, self.lr * self.rate)
+            self.bad_epochs = 0
+            print('validation PSNR plateaued at %f, learning rate lowered to %.7f'
+                   % (self.best, self.lr))
+
+
+def make_schedule(
+    name,
+    base_lr,
+    rate=0.1,
+    step_size=100,
+    max_epoch=100,
+    patience=5,
+    ):
+    """
+    Learning rate schedule of the training files. A schedule maps the epoch
+    to its learning rate; `update(psnr)` is called with the test PSNR after
+    every epoch.
+
+    :param name: one of SCHEDULES
+    :param rate: decay factor of the step and plateau schedules
+    :param step_size: epochs between two decays of the step schedule
+    :param max_epoch: length of the cosine schedule
+    :param patience: epochs without improvement before a plateau decay
+    """
+    if name == 'constant':
+        return StepSchedule(base_lr, 1.0, 1)
+    if name == 'step':
+        return StepSchedule(base_lr, rate, step_size)
+    if name == 'cosine':
+        return CosineSchedule(base_lr, max_epoch)
+    if name == 'plateau':
+        return PlateauSchedule(base_lr, rate, patience)
+    raise ValueError('unknown learning rate schedule %r, expected one of %s'
+                      % (name, ', '.join(SCHEDULES)))
+
+
+def cpu_seconds():
+    """
+    User and system CPU time of this process, all its threads included, and
+    of its child processes that have ended.
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class EarlyStopping(_Stateful):
+    """
+    Ends training once the validation PSNR has not improved by min_delta for
+    `patience` epochs, and reports the wall time and CPU time the remaining
+    epochs would have taken.
+
+    :param patience: epochs without improvement, 0 disables early stopping
+    :param min_delta: smallest PSNR gain in dB that counts as improvement
+    """
+
+    def __init__(self, patience=0, min_delta=0.01):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = None
+        self.best_epoch = None
+        self.epoch_seconds = []
+        self.epoch_cpu_seconds = []
+
+    def update(
+        self,
+        epoch,
+        metric,
+        seconds,
+        cpu_seconds=0.0,
+        ):
+        """
+        :param epoch: epoch that just ended
+        :param metric: its validation PSNR
+        :param seconds: its wall time
+        :param cpu_seconds: its CPU time, e.g. the difference of two
+            cpu_seconds() calls
+
+        :returns stop: whether training should end
+        """
+        self.epoch_seconds.append(seconds)
+        self.epoch_cpu_seconds.append(cpu_seconds)
+        metric = float(metric)
+        if self.best is None or metric > self.best + self.min_delta:
+            self.best = metric
+            self.best_epoch = epoch
+        return self.patience > 0 and epoch - self.best_epoch \
+            >= self.patience
+
+    def saved(self, epoch, max_epoch):
+        """
+        Estimated cost of the epochs after `epoch` that were not run.
+
+        :returns epochs, seconds, cpu_hours: skipped epochs, and their wall
+            time and CPU time at the mean of the epochs so far
+        """
+        epochs = max(0, max_epoch - epoch - 1)
+        seconds = epochs * sum(self.epoch_seconds) \
+            / max(1, len(self.epoch_seconds))
+        cpu_seconds = epochs * sum(self.epoch_cpu_seconds) \
+            / max(1, len(self.epoch_cpu_seconds))
+        return (epochs, seconds, cpu_seconds / 3600)
+
+    def report(self, epoch, max_epoch):
+        (epochs, seconds, cpu_hours) = self.saved(epoch, max_epoch)
+        return 'early stop after epoch %d: best PSNR %f at epoch %d, %d epochs skipped, saving %.1f min wall time and %.2f CPU-hours' \
+            % (epoch, self.best, self.best_epoch, epochs, seconds / 60,
+               cpu_hours)
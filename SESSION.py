@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import time
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+from functools import partial
+import numpy as np
+import tensorflow as tf
+
+GPU_DEVICE = '/gpu:0'
+CPU_DEVICE = '/cpu:0'
+
+
+def model_device(cpu_only=False):
+    """
+    Device MODEL.model / MODEL.unet should be built on.
+    """
+    return (CPU_DEVICE if cpu_only else GPU_DEVICE)
+
+
+def session_config(
+    intra_op_threads=0,
+    inter_op_threads=0,
+    cpu_only=False,
+    allow_soft_placement=True,
+    per_session_threads=False,
+    ):
+    """
+    :param intra_op_threads: threads a single op may use, 0 lets TensorFlow
+        pick the number of cores
+    :param inter_op_threads: ops run concurrently, 0 lets TensorFlow pick
+    :param cpu_only: hide all GPUs from the session
+    :param allow_soft_placement: fall back to an available device when an op
+        is pinned to a missing one
+    :param per_session_threads: give the session its own inter-op pool
+        instead of the process-wide one, so several configurations can be
+        compared in one process
+
+    :returns config: tf.ConfigProto
+    """
+    config = tf.ConfigProto(allow_soft_placement=allow_soft_placement,
+                            intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads,
+                            use_per_session_threads=per_session_threads)
+    if cpu_only:
+        config.device_count['GPU'] = 0
+    return config
+
+
+def pin_cpus(cpus):
+    """
+    Restricts the process, and the threads TensorFlow starts afterwards, to
+    the given cores. Python 2 has no os.sched_setaffinity, there psutil or
+    the taskset command of util-linux set the affinity instead.
+
+    :param cpus: iterable of core ids
+
+    :returns method: 'sched_setaffinity', 'psutil' or 'taskset'
+
+    :raises OSError: if none of them is available
+    """
+    cpus = sorted(set(cpus))
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+        return 'sched_setaffinity'
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        psutil.Process().cpu_affinity(cpus)
+        return 'psutil'
+    cpu_list = ','.join(str(cpu) for cpu in cpus)
+    with open(os.devnull, 'w') as devnull:
+        try:
+
+            # -a: every thread already started, e.g. the loader threads
+
+            subprocess.check_call(['taskset', '-a', '-p', '-c', cpu_list,
+                                  str(os.getpid())], stdout=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            raise OSError('cannot pin the process to cores %s: no sched_setaffinity, psutil or working taskset'
+                           % cpu_list)
+    return 'taskset'
+
+
+def make_session(graph=None, cpus=None, **kwargs):
+    """
+    Creates a tf.Session. Affinity is applied before the session starts its
+    thread pools, and raises OSError where it cannot be.
+
+    :param graph: graph to run, defaults to the default graph
+    :param cpus: optional core ids to pin the process to
+    :param kwargs: passed to session_config
+    """
+    if cpus is not None:
+        pin_cpus(cpus)
+    return tf.Session(graph=graph, config=session_config(**kwargs))
+
+
+def parse_cpus(value):
+    """
+    Parses a core list such as '0-3,8'.
+    """
+    cpus = []
+    for part in value.split(','):
+        if '-' in part:
+            (first, last) = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def add_session_args(parser):
+    parser.add_argument('--cpu', action='store_true',
+                        help='build the model on the CPU and hide all GPUs')
+    parser.add_argument('--intra_op_threads', type=int, default=0)
+    parser.add_argument('--inter_op_threads', type=int, default=0)
+    parser.add_argument('--cpus', type=parse_cpus,
+                        help='cores to pin the process to, e.g. 0-7')
+
+
+def session_args(args):
+    """
+    make_session keyword arguments from the flags of add_session_args.
+    """
+    return {
+        'cpu_only': args.cpu,
+        'intra_op_threads': args.intra_op_threads,
+        'inter_op_threads': args.inter_op_threads,
+        'cpus': args.cpus,
+        }
+
+
+def sweep_threads(
+    build_fn,
+    cores,
+    batch_size=1,
+    img_size=256,
+    steps=10,
+    warmup=2,
+    ):
+    """
+    Times CPU inference of build_fn for every intra-op / inter-op thread
+    count up to `cores`, with the process pinned to the first `cores` cores.
+
+    :param build_fn: callable building the network on an input tensor and
+        returning (output, weights)
+
+    :returns results: list of (intra_op_threads, inter_op_threads,
+        images_per_sec), fastest first
+    """
+    pin_cpus(range(cores))
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, shape=(batch_size, img_size,
+                           img_size, 1))
+        with tf.variable_scope('foo'):
+            (output, _) = build_fn(x, device=CPU_DEVICE)
+        init = tf.global_variables_initializer()
+    feed_dict = {x: np.random.rand(batch_size, img_size, img_size,
+                 1).astype(np.float32)}
+
+    counts = sorted(set([cores] + [2 ** i for i in range(8) if 2 ** i
+                    <= cores]))
+    results = []
+    for (intra, inter) in itertools.product(counts, [1, 2]):
+        with make_session(graph, cpu_only=True, intra_op_threads=intra,
+                          inter_op_threads=inter,
+                          per_session_threads=True) as sess:
+            sess.run(init)
+            for _ in range(warmup):
+                sess.run(output, feed_dict=feed_dict)
+            start = time.time()
+            for _ in range(steps):
+                sess.run(output, feed_dict=feed_dict)
+            rate = steps * batch_size / (time.time() - start)
+        results.append((intra, inter, rate))
+        print('intra %2d inter %d: %.2f images/sec' % (intra, inter,
+              rate))
+    return sorted(results, key=lambda result: -result[2])
+
+
+if __name__ == '__main__':
+    from MODEL import model, unet
+
+    parser = argparse.ArgumentParser(description='Find the fastest CPU thread configuration for a given core count.')
+    parser.add_argument('--model', choices=['vdsr', 'unet'],
+                        default='vdsr')
+    parser.add_argument('--cores', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--img_size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=10)
+    args = parser.parse_args()
+
+    build_fn = (model if args.model == 'vdsr' else partial(unet,
+                is_training=False))
+    results = sweep_threads(build_fn, args.cores, args.batch_size,
+                            args.img_size, args.steps)
+    print('best for %d cores: --intra_op_threads %d --inter_op_threads %d (%.2f images/sec)'
+           % ((args.cores, ) + results[0]))
@@ -10,8 +10,14 @@ import re
 from PSNR import psnr
 import scipy.io
 import pickle
-from MODEL import unet
+from MODEL import unet, restore_unet
+from EXPORT import checkpoint_config
+from INFER import pad_to_multiple
+from DATA import get_img_list
 from tf_unet import util
+from SESSION import add_session_args, make_session, model_device, \
+    session_args
+from TIMING import StepProfiler, add_profile_args
 
 # from MODEL_FACTORIZED import model_factorized
 
@@ -20,26 +26,24 @@ DATA_PATH = './data/test/'
 
 import argparse
 parser = argparse.ArgumentParser()
-parser.add_argument('--model_path')
-args = parser.parse_args()
-model_path = args.model_path
+parser.add_argument('--model_path', help='U-Net checkpoint to test, the network is read from its variable names')
+parser.add_argument('--fused_bn', action='store_true',
+                    help='build the U-Net with fused batch norm')
+add_session_args(parser)
+add_profile_args(parser)
+
+# the training files import this module with their own flags
 
+(args, _) = parser.parse_known_args()
+model_path = args.model_path
+profiler = StepProfiler(args.profile_steps, args.profile_dir)
 
-def get_img_list(data_path):
-    l = glob.glob(os.path.join(data_path, '*'))
-    l = [f for f in l if re.search("^\d+.mat$", os.path.basename(f))]
-    train_list = []
-    for f in l:
-        if os.path.exists(f):
-            if os.path.exists(f[:-4] + '_2.mat'):
-                train_list.append([f, f[:-4] + '_2.mat', 2])
-            if os.path.exists(f[:-4] + '_3.mat'):
-                train_list.append([f, f[:-4] + '_3.mat', 3])
-            if os.path.exists(f[:-4] + '_4.mat'):
-                train_list.append([f, f[:-4] + '_4.mat', 4])
-    return train_list
 
 def get_image_batch(train_list, offset, batch_size):
+
+    # the slices are stacked as they are, never padded or resized, so they
+    # must share one size; the placeholder takes any size
+
     target_list = train_list[offset:offset + batch_size]
     input_list = []
     gt_list = []
@@ -49,10 +53,8 @@ def get_image_batch(train_list, offset, batch_size):
         gt_img = scipy.io.loadmat(pair[0])['img_raw']
         input_list.append(input_img)
         gt_list.append(gt_img)
-    input_list = np.array(input_list)
-    input_list.resize([batch_size, input_list[0].shape[0],input_list[0].shape[1], 1])
-    gt_list = np.array(gt_list)
-    gt_list.resize([batch_size, gt_list[0].shape[0],gt_list[0].shape[1], 1])
+    input_list = np.array(input_list, dtype=np.float32)[..., np.newaxis]
+    gt_list = np.array(gt_list, dtype=np.float32)[..., np.newaxis]
     return (input_list, gt_list, np.array(cbcr_list))
 
 def get_test_image(test_list, offset, batch_size):
@@ -90,14 +92,17 @@ def test_VDSR_with_sess(
     ):
     folder_list = glob.glob(os.path.join(data_path))
     print 'folder_list', folder_list
-    saver.restore(sess, ckpt_path)
+    restore_unet(sess, ckpt_path)
 
     psnr_dict = {}
     for folder_path in folder_list:
         psnr_list = []
         img_list = get_img_list(folder_path)
         for i in range(len(img_list)):
-            (input_list, gt_list, scale_list) = get_image_batch(img_list, i, 2)
+
+            # every slice runs on its own at its own size
+
+            (input_list, gt_list, scale_list) = get_image_batch(img_list, i, 1)
 
             input_y = input_list
             gt_y = gt_list
@@ -107,8 +112,16 @@ def test_VDSR_with_sess(
             #                       feed_dict={input_tensor: np.resize(input_y,
             #                       (1, input_y.shape[0],
             #                       input_y.shape[1], 1))})
+
+            # mirror-padded to the pooling stride and cropped back, as
+            # INFER.Predictor does
+
+            (padded, height, width) = pad_to_multiple(input_y, multiple)
             img_vdsr_y = sess.run([output_tensor],
-                                  feed_dict={input_tensor: input_y})
+                                  feed_dict={input_tensor: padded},
+                                  **profiler.run_kwargs(i + 1))
+            img_vdsr_y = [img_vdsr_y[0][:, :height, :width]]
+            profiler.record(i + 1)
             print np.asarray(img_vdsr_y).shape
             # img_vdsr_y = np.resize(img_vdsr_y, (2, input_y.shape[1],
             #                        input_y.shape[2],1))
@@ -138,32 +151,45 @@ def test_VDSR_with_sess(
 
 
 def test_VDSR(epoch, ckpt_path, data_path):
-    with tf.Session() as sess:
+    with make_session(**session_args(args)) as sess:
         test_VDSR_with_sess(epoch, ckpt_path, data_path, sess)
 
 
 if __name__ == '__main__':
 
     # model_list = sorted(glob.glob("./checkpoints/VDSR_adam_epoch_*"))
-    model_list = "./checkpoints/500epochs/VDSR_adam4.cpkt"
+    model_list = (model_path or "./checkpoints/500epochs/VDSR_adam4.cpkt")
     # model_list = [fn for fn in model_list if not (os.path.basename(fn).endswith('meta'))]
                 #   or os.path.basename(fn).endswith('00001')
                 #   or os.path.basename(fn).endswith('index'))
     print 'models', model_list
     init = tf.global_variables_initializer()
-    with tf.Session() as sess:
+    with make_session(**session_args(args)) as sess:
         # sess.run(init)
-        input_tensor = tf.placeholder(tf.float32, shape=(2, None, None,
-                1))
-        shared_model = tf.make_template('shared_model', unet)
-        (output_tensor, weights) = shared_model(input_tensor,
-                is_training=True)
+
+        # the scope and size of the network the checkpoint holds, so
+        # restore_unet finds every variable by name
+
+        (scope, layers, features_root, channels) = \
+            checkpoint_config(model_list)
+        multiple = 2 ** (layers - 1)
+        input_tensor = tf.placeholder(tf.float32, shape=(None, None,
+                None, channels))
+        with tf.variable_scope(scope):
+            (output_tensor, weights) = unet(
+                input_tensor,
+                is_training=False,
+                channels=channels,
+                layers=layers,
+                features_root=features_root,
+                device=model_device(args.cpu),
+                fused_bn=args.fused_bn,
+                )
 
         # output_tensor, weights ....= model(input_tensor)
         # print weights
         print output_tensor
 
-        saver = tf.train.Saver(weights,write_version=tf.train.SaverDef.V1) #
         tf.global_variables_initializer().run()
         # for model_ckpt in model_list:
         print model_list
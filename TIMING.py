@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import json
+import time
+import collections
+import numpy as np
+
+
+class _Phase(object):
+
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.time() - self.start)
+
+
+class StepTimer(object):
+    """
+    Records the wall time of named training phases, e.g. data loading,
+    sess.run, image dumps and checkpointing. Every record is one append to a
+    bounded deque, so the timer can stay on in production runs; percentiles
+    are only computed when an epoch is logged.
+
+    Phases are timed either with `with timer.phase(name):` or with
+    `timer.mark(name)`, which charges the time since the previous mark to
+    `name`. Both may be used from worker threads.
+
+    :param window: number of most recent records per phase the rolling
+        percentiles are computed over
+    :param log_path: optional file every epoch summary is appended to as one
+        JSON line
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window=2000, log_path=None):
+        self.window = window
+        self.log_path = log_path
+        self.records = collections.OrderedDict()
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.last_mark = time.time()
+
+    def add(self, name, seconds):
+        records = self.records.get(name)
+        if records is None:
+            records = self.records.setdefault(name,
+                    collections.deque(maxlen=self.window))
+        records.append(seconds)
+        self.totals[name] += seconds
+        self.counts[name] += 1
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def start(self):
+        """
+        Resets the reference point of `mark`, e.g. before the first step.
+        """
+        self.last_mark = time.time()
+
+    def mark(self, name):
+        now = time.time()
+        self.add(name, now - self.last_mark)
+        self.last_mark = now
+
+    def summary(self):
+        """
+        :returns summary: {phase: {count, total, mean, p50, p95, p99}}. count
+            and total cover the epoch so far, the percentiles the rolling
+            window, all in seconds
+        """
+        summary = collections.OrderedDict()
+        for (name, records) in list(self.records.items()):
+            if not self.counts[name]:
+                continue
+            values = np.array(records)
+            stats = collections.OrderedDict([('count', self.counts[name]),
+                    ('total', self.totals[name]), ('mean',
+                    self.totals[name] / self.counts[name])])
+            for (q, value) in zip(self.PERCENTILES,
+                                  np.percentile(values,
+                                  self.PERCENTILES)):
+                stats['p%d' % q] = float(value)
+            summary[name] = stats
+        return summary
+
+    def log_epoch(self, epoch):
+        """
+        Writes the summary of the epoch, one line per phase, to stdout and to
+        log_path, then starts a new epoch. The rolling windows are kept.
+
+        :returns summary: see summary()
+        """
+        summary = self.summary()
+        for (name, stats) in summary.items():
+            print('time %-8s n %5d\t total %8.2fs\t p50 %.4fs\t p95 %.4fs\t p99 %.4fs'
+                   % (name, stats['count'], stats['total'], stats['p50'],
+                  stats['p95'], stats['p99']))
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps({'epoch': epoch, 'time': time.time(),
+                        'phases': summary}) + '\n')
+        self.totals.clear()
+        self.counts.clear()
+        return summary
+
+
+def parse_steps(value):
+    """
+    Parses a step range such as '100-110', or a single step '100'.
+
+    :returns first, last: inclusive bounds
+    """
+    (first, _, last) = value.partition('-')
+    return (int(first), int(last or first))
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile_steps', type=parse_steps,
+                        help='trace these steps, e.g. 100-110')
+    parser.add_argument('--profile_dir', default='./profile',
+                        help='Chrome traces and op summary of --profile_steps')
+
+
+class StepProfiler(object):
+    """
+    Traces the sess.run of a range of steps with full run metadata. Every
+    traced step is written to out_dir/step_<n>.json in Chrome trace format
+    (open it at chrome://tracing). Once the last step of the range is
+    recorded, the time per op type and per op, summed over the range, is
+    printed sorted by total time and written to out_dir/ops.txt.
+
+    Usage: `sess.run(fetches, **profiler.run_kwargs(step))` followed by
+    `profiler.record(step)`. Outside the range both cost nothing.
+
+    :param steps: inclusive (first, last) step range, None disables tracing
+    :param out_dir: directory of the traces and the summary
+    :param top: ops listed in the per-op part of the summary
+    """
+
+    def __init__(
+        self,
+        steps=None,
+        out_dir='./profile',
+        top=30,
+        ):
+        self.steps = steps
+        self.out_dir = out_dir
+        self.top = top
+        self.run_metadata = None
+        self.by_type = collections.defaultdict(lambda : [0, 0.0])
+        self.by_node = collections.defaultdict(lambda : [0, 0.0])
+
+    def active(self, step):
+        return self.steps is not None and self.steps[0] <= step \
+            <= self.steps[1]
+
+    def run_kwargs(self, step):
+        """
+        sess.run keyword arguments for step: a full trace inside the range,
+        none outside of it.
+        """
+        if not self.active(step):
+            return {}
+        import tensorflow as tf
+        self.run_metadata = tf.RunMetadata()
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': self.run_metadata}
+
+    def record(self, step):
+        if not self.active(step) or self.run_metadata is None:
+            return
+        from tensorflow.python.client import timeline
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        step_stats = self.run_metadata.step_stats
+        self.run_metadata = None
+        with open(os.path.join(self.out_dir, 'step_%d.json' % step), 'w'
+                  ) as f:
+            f.write(timeline.Timeline(step_stats).generate_chrome_trace_format())
+
+        for dev_stats in step_stats.dev_stats:
+
+            # GPU stream views repeat the kernels of the device itself
+
+            if '/stream:' in dev_stats.device or '/memcpy' \
+                in dev_stats.device:
+                continue
+            for node in dev_stats.node_stats:
+                seconds = node.all_end_rel_micros / 1e6
+                label = node.timeline_label
+                op_type = (label.split(' = ', 1)[1].split('(', 1)[0]
+                           if ' = ' in label else node.node_name)
+                for (stats, key) in ((self.by_type, op_type),
+                        (self.by_node, node.node_name)):
+                    stats[key][0] += 1
+                    stats[key][1] += seconds
+
+        if step == self.steps[1]:
+            summary = self.summary()
+            print(summary)
+            with open(os.path.join(self.out_dir, 'ops.txt'), 'w') as f:
+                f.write(summary + '\n')
+
+    def summary(self):
+        """
+        :returns table: time per op type and of the `top` slowest ops over
+            the recorded steps, sorted by total time
+        """
+        total = sum(seconds for (_, seconds) in self.by_type.values()) \
+            or 1.0
+        lines = []
+        for (title, stats, rows) in (('op type', self.by_type,
+                None), ('op', self.by_node, self.top)):
+            lines.append('%-60s %7s %10s %10s %6s' % (title, 'count',
+                         'total ms', 'mean ms', '%'))
+            ranked = sorted(stats.items(), key=lambda item: -item[1][1])
+            for (name, (count, seconds)) in ranked[:rows]:
+                lines.append('%-60s %7d %10.3f %10.4f %6.2f' % (name[-60:],
+                             count, seconds * 1e3, seconds * 1e3 / count,
+                             100 * seconds / total))
+            lines.append('')
+        return '\n'.join(lines)
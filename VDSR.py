@@ -19,6 +19,21 @@ from MODEL import model
 from MODEL import unet
 from PSNR import psnr
 from TEST import test_VDSR
+from DATA import BatchAssembler, EvalSet, PatchStore, SliceDataset, \
+    get_train_list, dataset_stats
+from LOADER import BatchPrefetcher, make_dataset
+from EVAL import BackgroundEvaluator, eval_metrics, run_eval, \
+    running_means
+from TIMING import StepProfiler, StepTimer, add_profile_args
+from OPTIMIZE import accumulating_minimize
+from SESSION import add_session_args, make_session, model_device, \
+    session_args
+from CHECKPOINT import CheckpointWriter, load_training_state, \
+    training_state_path
+from SCHEDULE import EarlyStopping, cpu_seconds, make_schedule
+from SAMPLER import EpochSampler
+from PARALLEL import DataParallel, RingAllReduce, shard
+from functools import partial
 import os
 from tf_unet import util
 
@@ -28,7 +43,7 @@ DATA_PATH = './data/bp_ang90_snr20_train/'
 TEST_DATA_PATH = './data/bp_ang90_snr20_test/'
 ckpt_path = './checkpoints/bp_ang90_snr20/VDSR_adam4.cpkt'
 IMG_SIZE = (256, 256)
-TEST_SIZE = (256, 256)
+EVAL_COUNT = 10  # test slices evaluated after every epoch
 BATCH_SIZE = 4
 USE_ADAM_OPT = True
 if USE_ADAM_OPT:
@@ -38,173 +53,291 @@ else:
 LR_RATE = 0.1
 LR_STEP_SIZE = 100  # epoch
 MAX_EPOCH = 100
-
-USE_QUEUE_LOADING = False
+LR_SCHEDULE = 'step'  # 'constant', 'step', 'cosine' or 'plateau' on the test PSNR
+LR_PATIENCE = 5  # epochs without test PSNR gain before a plateau decay
+EARLY_STOP_PATIENCE = 0  # epochs without test PSNR gain before training ends, 0 disables
+STEPS_PER_EPOCH = None  # fixed steps per epoch, None covers EPOCH_FRACTION of train_list
+EPOCH_FRACTION = 1.0  # share of train_list one epoch samples when STEPS_PER_EPOCH is None
+DROP_LAST = True  # skip the short last batch of an epoch
+
+USE_QUEUE_LOADING = False  # tf.data input pipeline instead of feed_dict
+NUM_PARALLEL_CALLS = 8  # parallel decodes in the tf.data pipeline
+PREFETCH_DEPTH = 4  # batches built ahead of the running step
+PREFETCH_WORKERS = 2
+PREFETCH_PROCESSES = False  # worker processes instead of threads
+EVAL_EVERY = 0  # global steps between background evaluations, 0 disables
+TIMING_LOG = './timing.jsonl'  # per-epoch phase timings, None to only print
+LOG_EVERY = 0  # steps between running loss lines, 0 logs once per epoch
+PRECISION = 'float32'  # 'float16' or 'bfloat16' activations, weights stay float32
+ACCUMULATE_STEPS = 1  # micro-batches of BATCH_SIZE per weight update
+CKPT_KEEP = 5  # most recent checkpoints kept next to ckpt_path
+CKPT_KEEP_BEST = 1  # checkpoints with the best test PSNR kept as well
+STATE_EVERY = 1000  # steps between training state checkpoints, 0 saves once per epoch
+SEED = None  # shuffle seed, None draws one; it is kept in the training state
+LOSS_SCALE = 128.0  # initial loss scale of float16 training, halved on overflow
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--model_path')
+parser.add_argument('--resume', action='store_true',
+                    help='continue from the newest training state of ckpt_path')
+parser.add_argument('--store_path',
+                    help='patch store packed from DATA_PATH by DATA.py')
+parser.add_argument('--slice_path',
+                    help='full-size slice pairs to cut patches from at batch time')
+parser.add_argument('--sample_weights',
+                    help='.npy of one sampling weight per training sample')
+add_session_args(parser)
+add_profile_args(parser)
 args = parser.parse_args()
 model_path = args.model_path
+device = model_device(args.cpu)
+patch_store = None
+slice_dataset = None
 
+# every batch in flight or in use gets its own preallocated float32 buffer
 
-def get_img_list(data_path):
-    l = glob.glob(os.path.join(data_path, '*'))
-    l = [f for f in l if re.search("^\d+.mat$", os.path.basename(f))]
-    train_list = []
-    for f in l:
-        if os.path.exists(f):
-            if os.path.exists(f[:-4] + '_2.mat'):
-                train_list.append([f, f[:-4] + '_2.mat', 2])
-            if os.path.exists(f[:-4] + '_3.mat'):
-                train_list.append([f, f[:-4] + '_3.mat', 3])
-            if os.path.exists(f[:-4] + '_4.mat'):
-                train_list.append([f, f[:-4] + '_4.mat', 4])
-    return train_list
-
-
-def get_train_list(data_path):
-    l = glob.glob(os.path.join(data_path, '*'))
-    print len(l)
-    l = [f for f in l if re.search("^\d+.mat$", os.path.basename(f))]
-    print len(l)
-    train_list = []
-    for f in l:
-        if os.path.exists(f):
-            if os.path.exists(f[:-4] + '_2.mat'):
-                train_list.append([f, f[:-4] + '_2.mat'])
-            if os.path.exists(f[:-4] + '_3.mat'):
-                train_list.append([f, f[:-4] + '_3.mat'])
-            if os.path.exists(f[:-4] + '_4.mat'):
-                train_list.append([f, f[:-4] + '_4.mat'])
-    return train_list
-
-
-def get_image_batch(train_list, offset, batch_size):
-    target_list = train_list[offset:offset + batch_size]
-    input_list = []
-    gt_list = []
-    cbcr_list = []
-    for pair in target_list:
-        input_img = scipy.io.loadmat(pair[1])['patch']
-        gt_img = scipy.io.loadmat(pair[0])['patch']
-        input_list.append(input_img)
-        gt_list.append(gt_img)
-    input_list = np.array(input_list)
-    input_list.resize([BATCH_SIZE, IMG_SIZE[1], IMG_SIZE[0], 1])
-    gt_list = np.array(gt_list)
-    gt_list.resize([BATCH_SIZE, IMG_SIZE[1], IMG_SIZE[0], 1])
-    return (input_list, gt_list, np.array(cbcr_list))
+batch_assembler = BatchAssembler(BATCH_SIZE, IMG_SIZE,
+                                 num_buffers=PREFETCH_DEPTH
+                                 + PREFETCH_WORKERS + 1)
 
+# wall time per training phase, summarised once per epoch
 
-def get_test_image(test_list, offset, batch_size):
-    target_list = test_list[offset:offset + batch_size]
-    print target_list
-    input_list = []
-    gt_list = []
+step_timer = StepTimer(log_path=TIMING_LOG)
+
+
+def get_image_batch(train_list, indices):
+    target_list = [train_list[i] for i in indices]
     cbcr_list = []
-    for pair in target_list:
-        input_img = scipy.io.loadmat(pair[1])['img_2']
-        gt_img = scipy.io.loadmat(pair[0])['img_raw']
-        input_list.append(input_img)
-        gt_list.append(gt_img)
-    input_list = np.array(input_list)
-    input_list.resize([batch_size, input_list[0].shape[0],
-                      input_list[0].shape[1], 1])
-    gt_list = np.array(gt_list)
-    gt_list.resize([batch_size, gt_list[0].shape[0],
-                   gt_list[0].shape[1], 1])
+    if slice_dataset is not None:
+        (input_list, gt_list) = \
+            batch_assembler.sample_slices(slice_dataset, target_list)
+    elif patch_store is not None:
+        (input_list, gt_list) = batch_assembler.read_store(patch_store,
+                target_list)
+    else:
+        (input_list, gt_list) = batch_assembler.load_mat(target_list)
     return (input_list, gt_list, np.array(cbcr_list))
 
 
 if __name__ == '__main__':
-    train_list = get_train_list(DATA_PATH)
+
+    # set by `python PARALLEL.py launch`, None in a single process run
+
+    ring = RingAllReduce.from_environment()
+
+    # the training state sidecar is read before anything depends on the
+    # seed or the epoch
+
+    resume_start = time.time()
+    state_path = training_state_path(ckpt_path)
+    resume_state = None
+    if args.resume and (ring is None or ring.rank == 0):
+        resume_state = load_training_state(state_path)
+
+    # only worker 0 writes the training state, the other workers of a
+    # data-parallel run continue from its sidecar and its variables
+
+    if args.resume and ring is not None:
+        resume_state = ring.broadcast_object(resume_state)
+    if args.resume and resume_state is None:
+        print 'no training state under %s, starting from scratch' \
+            % state_path
+    seed = (resume_state['seed'] if resume_state else SEED)
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+
+    if args.slice_path:
+
+        # patches are cut at batch time, train_list holds their sample
+        # indices; the seed makes the cuts of a resumed run the same
+
+        slice_dataset = SliceDataset.open(args.slice_path,
+                patch_size=IMG_SIZE[0], seed=seed)
+        train_list = list(range(len(slice_dataset)))
+    elif args.store_path:
+
+        # train_list holds store positions instead of .mat file pairs
+
+        patch_store = PatchStore(args.store_path)
+        train_list = list(range(len(patch_store)))
+    else:
+        print 'dataset:', dataset_stats(DATA_PATH)
+        train_list = get_train_list(DATA_PATH)
+
+    # every data-parallel worker trains on its own part of the data
+
+    if ring is not None:
+        train_list = shard(train_list, ring.rank, ring.world_size)
+
+    # the test slices are decoded once per run, not once per epoch
+
+    eval_set = EvalSet.open(TEST_DATA_PATH, EVAL_COUNT)
+    print 'eval set: %d slices, baseline PSNR %f' % (len(eval_set),
+            eval_set.baseline_psnr)
+
+    # every epoch draws its own permutation, or weighted sample, of
+    # train_list from the seed and the epoch number, so a resumed run
+    # recreates it
+
+    sample_weights = None
+    if args.sample_weights:
+        sample_weights = np.load(args.sample_weights)
+        if ring is not None:
+            sample_weights = shard(sample_weights, ring.rank,
+                                   ring.world_size)
+    sampler = EpochSampler(
+        len(train_list),
+        BATCH_SIZE,
+        STEPS_PER_EPOCH,
+        EPOCH_FRACTION,
+        weights=sample_weights,
+        drop_last=DROP_LAST,
+        seed=seed,
+        )
 
     if not USE_QUEUE_LOADING:
         print 'not use queue loading, just sequential loading...'
 
         # ## WITHOUT ASYNCHRONOUS DATA LOADING ###
 
-        train_input = tf.placeholder(tf.float32, shape=(BATCH_SIZE,
+        # the last batch of a pass may be short, it is not zero padded
+
+        train_input = tf.placeholder(tf.float32, shape=(None,
                 IMG_SIZE[0], IMG_SIZE[1], 1))
-        train_gt = tf.placeholder(tf.float32, shape=(BATCH_SIZE,
-                                  IMG_SIZE[0], IMG_SIZE[1], 1))
-        test_input = tf.placeholder(tf.float32, shape=(10, TEST_SIZE[0],
-                                    TEST_SIZE[1], 1))
+        train_gt = tf.placeholder(tf.float32, shape=(None, IMG_SIZE[0],
+                                  IMG_SIZE[1], 1))
+        test_input = tf.placeholder(tf.float32, shape=(None, None,
+                                    None, 1))
     else:
-
-        # ## WITHOUT ASYNCHRONOUS DATA LOADING ###
-
-        print 'use queue loading'
+        print 'use tf.data loading'
 
         # ## WITH ASYNCHRONOUS DATA LOADING ###
 
-        train_input_single = tf.placeholder(tf.float32,
-                shape=(IMG_SIZE[0], IMG_SIZE[1], 1))
-        train_gt_single = tf.placeholder(tf.float32,
-                shape=(IMG_SIZE[0], IMG_SIZE[1], 1))
-        q = tf.FIFOQueue(10000, [tf.float32, tf.float32],
-                         [[IMG_SIZE[0], IMG_SIZE[1], 1], [IMG_SIZE[0],
-                         IMG_SIZE[1], 1]])
-        enqueue_op = q.enqueue([train_input_single, train_gt_single])
-
-        (train_input, train_gt) = q.dequeue_many(BATCH_SIZE)
+        # the batches of the sampler, from the epoch and step a resumed
+        # run continues at
+
+        dataset = make_dataset(
+            train_list,
+            BATCH_SIZE,
+            IMG_SIZE,
+            num_parallel_calls=NUM_PARALLEL_CALLS,
+            patch_store=patch_store,
+            slice_dataset=slice_dataset,
+            sampler=sampler,
+            first_epoch=(resume_state['epoch'] if resume_state else 0),
+            first_step=(resume_state['step'] if resume_state else 0),
+            )
+        (train_input, train_gt) = \
+            dataset.make_one_shot_iterator().get_next()
+        test_input = tf.placeholder(tf.float32, shape=(None, None,
+                                    None, 1))
 
         # ## WITH ASYNCHRONOUS DATA LOADING ###
 
     # shared_model = tf.make_template('shared_model', model)
 
     with tf.variable_scope('foo'):  # create the first time
-        (train_output, weights) = model(train_input)
+        (train_output, weights) = model(train_input, device=device,
+                dtype=PRECISION)
     with tf.variable_scope('foo', reuse=True):  # create the second time
-        (test_output, _) = model(test_input)
+        (test_output, _) = model(test_input, device=device,
+                dtype=PRECISION)
+    test_gt = tf.placeholder(tf.float32, shape=test_input.shape)
+
+    # the loss of an output error, training and evaluation report the same
+
+    def loss_fn(error):
+        return tf.reduce_mean(tf.nn.l2_loss(error))
+
+    (test_prediction, test_loss, test_psnr) = eval_metrics(test_output,
+            test_input, test_gt, residual=False, loss_fn=loss_fn)
 
     # train_res = tf.subtract(train_gt, train_input)
     # loss = tf.reduce_sum(tf.nn.l2_loss(tf.subtract(train_output, train_res)))
 	# acc = tf.reduce_mean(tf.cast(tf.equal(train_output, train_res),tf.float32))
 
-    loss = tf.reduce_mean(tf.nn.l2_loss(tf.subtract(train_output,train_gt)))
+    loss = loss_fn(tf.subtract(train_output, train_gt))
 
     acc = tf.reduce_mean(tf.cast(tf.equal(train_output, train_gt),tf.float32))
 
     # for w in weights:
     # ....loss += tf.nn.l2_loss(w)*1e-4
 
+    # loss and acc are averaged on the device, a step only fetches scalars
+    # and train_output is copied back once per epoch for the preview
+
+    ((mean_loss, mean_acc), update_means, reset_means) = \
+        running_means([loss, acc])
+
     global_step = tf.Variable(0, trainable=False)
 
     # learning_rate ....= tf.train.exponential_decay(BASE_LR, global_step*BATCH_SIZE, len(train_list)*LR_STEP_SIZE, LR_RATE, staircase=True)
 
     learning_rate = tf.Variable(BASE_LR)
 
-    if USE_ADAM_OPT:
-        optimizer = tf.train.AdamOptimizer(learning_rate)  # tf.train.MomentumOptimizer(learning_rate, 0.9)
-        opt = optimizer.minimize(loss, global_step=global_step)
+    # the schedule sets learning_rate at the start of every epoch and
+    # sees the test PSNR at its end
+
+    lr_schedule = make_schedule(
+        LR_SCHEDULE,
+        BASE_LR,
+        LR_RATE,
+        LR_STEP_SIZE,
+        MAX_EPOCH,
+        LR_PATIENCE,
+        )
+    early_stopping = EarlyStopping(EARLY_STOP_PATIENCE)
+
+    # Adam, or momentum with every gradient clipped to 0.01. In float16 the
+    # loss is scaled so that small gradients survive the backward pass,
+    # and a step whose gradients overflow is skipped.
+    # accumulate only sums the gradients of a micro-batch, opt also applies
+    # the mean of the last ACCUMULATE_STEPS of them
+
+    data_parallel = None
+    if ring is None:
+        (accumulate, opt) = accumulating_minimize(
+            loss,
+            global_step,
+            learning_rate,
+            ACCUMULATE_STEPS,
+            use_adam=USE_ADAM_OPT,
+            clip_norm=0.01,
+            loss_scale=(LOSS_SCALE if PRECISION == 'float16' else None),
+            )
     else:
-        optimizer = tf.train.MomentumOptimizer(learning_rate, 0.9)
-
-        lr = BASE_LR
-        BASE_NORM = 0.1
-        tvars = tf.trainable_variables()
-        gvs = zip(tf.gradients(loss, tvars), tvars)
 
-        # norm = BASE_NORM*BASE_LR/lr
-        # capped_gvs = [(tf.clip_by_norm(grad, norm), var) for grad, var in gvs]
-
-        norm = 0.01
-        capped_gvs = [(tf.clip_by_norm(grad, norm), var) for (grad,
-                      var) in gvs]
-        opt = optimizer.apply_gradients(capped_gvs,
-                global_step=global_step)
+        # every step fetches the flat gradient vector, DataParallel
+        # averages it over the ring and applies it on every worker
+
+        if ACCUMULATE_STEPS > 1:
+            raise ValueError('ACCUMULATE_STEPS > 1 is not supported in a data-parallel run')
+        data_parallel = DataParallel(
+            ring,
+            loss,
+            global_step,
+            learning_rate,
+            use_adam=USE_ADAM_OPT,
+            clip_norm=0.01,
+            loss_scale=(LOSS_SCALE if PRECISION == 'float16' else None),
+            )
+        accumulate = opt = data_parallel.flat_grad
+    is_chief = data_parallel is None or data_parallel.is_chief
+
+    # the full training state: every global variable, i.e. the weights,
+    # optimizer slots, global_step and learning_rate
+
+    state_variables = tf.global_variables()
+    state_saver = tf.train.Saver(state_variables)
 
     saver = tf.train.Saver(weights, max_to_keep=5,
                            write_version=tf.train.SaverDef.V2)
 
-    shuffle(train_list)
-
     # config = tf.ConfigProto()
 
     # config.operation_timeout_in_ms=10000
 
-    with tf.Session() as sess:
+    with make_session(**session_args(args)) as sess:
         tf.global_variables_initializer().run()
 
         if model_path:
@@ -212,43 +345,81 @@ if __name__ == '__main__':
             saver.restore(sess, model_path)
             print 'Done'
 
+        (start_epoch, first_step, micro_step) = (0, 0, 0)
+        if resume_state is not None:
+            if is_chief:
+                state_saver.restore(sess, resume_state['path'])
+            lr_schedule.set_state(resume_state['lr_schedule'])
+            early_stopping.set_state(resume_state['early_stopping'])
+            (start_epoch, first_step, micro_step) = (resume_state['epoch'
+                    ], resume_state['step'], resume_state['micro_step'])
+            print 'resumed epoch %d step %d from %s in %.2fs' \
+                % (start_epoch, first_step, resume_state['path'],
+                   time.time() - resume_start)
 
-        # ## WITH ASYNCHRONOUS DATA LOADING ###
 
-        def load_and_enqueue(
-            coord,
-            file_list,
-            enqueue_op,
-            train_input_single,
-            train_gt_single,
-            idx=0,
-            num_thread=1,
-            ):
-
-            count = 0
-            length = len(file_list)
-            try:
-                while not coord.should_stop():
-                    i = count % length
-
-                    # i = random.randint(0, length-1)
-
-                    input_img = \
-                        scipy.io.loadmat(file_list[i][1])['patch'
-                            ].reshape([IMG_SIZE[0], IMG_SIZE[1], 1])
-                    gt_img = scipy.io.loadmat(file_list[i][0])['patch'
-                            ].reshape([IMG_SIZE[0], IMG_SIZE[1], 1])
-                    sess.run(enqueue_op,
-                             feed_dict={train_input_single: input_img,
-                             train_gt_single: gt_img})
-                    count += 1
-            except Exception, e:
-                print 'stopping...', idx, e
+        # start every worker from the weights of worker 0, or from all of
+        # the training state it resumed, optimizer slots and global_step
+        # included
 
+        if data_parallel is not None:
+            data_parallel.broadcast(sess, (state_variables if resume_state
+                                    else None))
 
-        # ## WITH ASYNCHRONOUS DATA LOADING ###
+        prefetcher = None
+        if not USE_QUEUE_LOADING:
+
+            # train_list reaches every worker once, the tasks are only the
+            # sample indices; the workers' load time is charged to 'load'
+
+            prefetcher = BatchPrefetcher(
+                get_image_batch,
+                depth=PREFETCH_DEPTH,
+                num_workers=PREFETCH_WORKERS,
+                use_processes=PREFETCH_PROCESSES,
+                shared=train_list,
+                timer=step_timer,
+                )
+
+        # ckpt_path-<step> checkpoints, written atomically on a background
+        # thread
+
+        checkpoints = None
+        state_writer = None
+        if is_chief:
+            checkpoints = CheckpointWriter(weights, ckpt_path,
+                    keep=CKPT_KEEP, keep_best=CKPT_KEEP_BEST)
+            state_writer = CheckpointWriter(state_variables, state_path,
+                    keep=1, keep_best=0)
+
+
+        def training_state(epoch, step):
+
+            # sidecar of a training state checkpoint: where to continue
+
+            return {
+                'epoch': epoch,
+                'step': step,
+                'micro_step': micro_step,
+                'seed': seed,
+                'lr_schedule': lr_schedule.get_state(),
+                'early_stopping': early_stopping.get_state(),
+                }
+
+
+        # Chrome traces of --profile_steps, numbered like micro_step from 1
+
+        profiler = StepProfiler((args.profile_steps if is_chief else None),
+                                args.profile_dir)
+
+        # evaluates weight snapshots every EVAL_EVERY steps on its own thread
 
-        threads = []
+        evaluator = None
+        if EVAL_EVERY and is_chief:
+            evaluator = BackgroundEvaluator(partial(model,
+                    device=device, dtype=PRECISION), eval_set,
+                    every=EVAL_EVERY, residual=False,
+                    loss_fn=loss_fn)
 
 
         def signal_handler(signum, frame):
@@ -256,9 +427,14 @@ if __name__ == '__main__':
             # print "stop training, save checkpoint..."
             # saver.save(sess, "./checkpoints/VDSR_norm_clip_epoch_%03d.ckpt" % epoch ,global_step=global_step)
 
-            sess.run(q.close(cancel_pending_enqueues=True))
-            coord.request_stop()
-            coord.join(threads)
+            if prefetcher is not None:
+                prefetcher.close()
+            if evaluator is not None:
+                evaluator.close()
+            if checkpoints is not None:
+                checkpoints.close()
+            if state_writer is not None:
+                state_writer.close()
             print 'Done'
             sys.exit(1)
 
@@ -266,202 +442,170 @@ if __name__ == '__main__':
         original_sigint = signal.getsignal(signal.SIGINT)
         signal.signal(signal.SIGINT, signal_handler)
 
-        if USE_QUEUE_LOADING:
-            lrr = BASE_LR
-            for epoch in xrange(0, MAX_EPOCH):
-                if epoch % LR_STEP_SIZE == 0:
-
-                    train_input_single = tf.placeholder(tf.float32,
-                            shape=(IMG_SIZE[0], IMG_SIZE[1], 1))
-                    train_gt_single = tf.placeholder(tf.float32,
-                            shape=(IMG_SIZE[0], IMG_SIZE[1], 1))
-                    q = tf.FIFOQueue(1000, [tf.float32, tf.float32],
-                            [[IMG_SIZE[0], IMG_SIZE[1], 1],
-                            [IMG_SIZE[0], IMG_SIZE[1], 1]])
-                    enqueue_op = q.enqueue([train_input_single,
-                            train_gt_single])
-
-                    (train_input, train_gt) = q.dequeue_many(BATCH_SIZE)
-
-                    # ## WITH ASYNCHRONOUS DATA LOADING ###
-
-                    (train_output, weights) = shared_model(train_input,
-                            is_training=True)
-                    loss = \
-                        tf.reduce_mean(tf.nn.l2_loss(tf.subtract(train_output,
-                            train_gt)))
-                    acc = tf.reduce_mean(tf.equal(train_output,
-                            train_gt))
-
-                    # for w in weights:
-                    # ....loss += tf.nn.l2_loss(w)*1e-4
-
-                    if USE_ADAM_OPT:
-                        opt = optimizer.minimize(loss,
-                                global_step=global_step)
-                    else:
-
-                        lr = BASE_LR
-                        BASE_NORM = 0.1
-                        tvars = tf.trainable_variables()
-                        gvs = zip(tf.gradients(loss, tvars), tvars)
-
-                        # norm = BASE_NORM*BASE_LR/lr
-                        # capped_gvs = [(tf.clip_by_norm(grad, norm), var) for grad, var in gvs]
-
-                        norm = 0.01
-                        capped_gvs = [(tf.clip_by_norm(grad, norm),
-                                var) for (grad, var) in gvs]
-                        opt = optimizer.apply_gradients(capped_gvs,
-                                global_step=global_step)
-
-                # create threads
-
-                num_thread = 20
-                print 'num thread:', len(threads)
-                del threads[:]
-                coord = tf.train.Coordinator()
-                print 'delete threads...'
-                print 'num thread:', len(threads)
-                for i in range(num_thread):
-                    length = len(train_list) / num_thread
-                    t = threading.Thread(target=load_and_enqueue, args=(
-                        coord,
-                        train_list[i * length:(i + 1) * length],
-                        enqueue_op,
-                        train_input_single,
-                        train_gt_single,
-                        i,
-                        num_thread,
-                        ))
-                    threads.append(t)
-                    t.start()
-
-                for step in range(len(train_list) // BATCH_SIZE):
-
-                    (
-                        _,
-                        l,
-                        accuracy,
-                        output,
-                        lr,
-                        g_step,
-                        ) = sess.run([
-                        opt,
-                        loss,
-                        acc,
-                        train_output,
-                        learning_rate,
-                        global_step,
-                        ])
-                print '[epoch %2.4f] loss %.4f\t acc %.4f\t lr %.7f' \
-                    % (epoch + float(step) * BATCH_SIZE
-                       / len(train_list), np.sum(l), accuracy, lr)
-
-                # print "[epoch %2.4f] loss %.4f\t lr %.5f\t norm %.2f"%(epoch+(float(step)*BATCH_SIZE/len(train_list)), np.sum(l)/BATCH_SIZE, lr, norm)
-                # saver.save(sess, "./checkpoints/VDSR_adam_epoch_%03d.ckpt" % epoch ,global_step=global_step)
-
-                saver.save(sess, ckpt_path)
-                if epoch % LR_STEP_SIZE == 19:
-                    sess.run(q.close(cancel_pending_enqueues=True))
-                    print 'request stop...'
-                    coord.request_stop()
-                    print 'join threads...'
-                    coord.join(threads, stop_grace_period_secs=10)
-                    lrr = lrr / 10
-        else:
-            prediction_path = './prediction_bp_ang90_snr20_VDSR'
-            prediction_path = os.path.abspath(prediction_path)
-            if not os.path.exists(prediction_path):
-                os.makedirs(prediction_path)
-				#len(train_list) // BATCH_SIZE
-            for epoch in xrange(0, MAX_EPOCH):
-                for step in range(2000):
-                    offset = step * BATCH_SIZE
-                    (input_data, gt_data, cbcr_data) = \
-                        get_image_batch(train_list, offset, BATCH_SIZE)
+        prediction_path = './prediction_bp_ang90_snr20_VDSR'
+        prediction_path = os.path.abspath(prediction_path)
+        if not os.path.exists(prediction_path):
+            os.makedirs(prediction_path)
+			#len(train_list) // BATCH_SIZE
+        for epoch in xrange(start_epoch, MAX_EPOCH):
+            (epoch_start, epoch_cpu) = (time.time(), cpu_seconds())
+            if epoch > start_epoch:
+                first_step = 0
+            learning_rate.load(lr_schedule(epoch), sess)
+            steps = len(sampler)
+            if USE_QUEUE_LOADING:
+                batches = [(None, None, None)] * (steps - first_step)
+            else:
+                batches = prefetcher.iterate(sampler.batches(epoch,
+                        first_step))
+            sess.run(reset_means)
+            step_timer.start()
+            for (step, (input_data, gt_data, cbcr_data)) in \
+                enumerate(batches, first_step):
+                step_timer.mark('data')
+                preview = step == steps - 1
+                micro_step += 1
+                train_op = (opt if micro_step % ACCUMULATE_STEPS
+                            == 0 else accumulate)
+                fetches = [train_op, update_means, global_step]
+                if preview:
+                    fetches += [train_output, learning_rate]
+                if input_data is None:
+
+                    # the tf.data batch only lives in the graph, bring the
+                    # last one back for the preview
+
+                    feed_dict = None
+                    if preview:
+                        fetches += [train_input, train_gt]
+                else:
                     feed_dict = {train_input: input_data,
                                  train_gt: gt_data}
 
-                    (
-                        _,
-                        l,
-                        accuracy,
-                        output,
-                        lr,
-                        g_step,
-                        ) = sess.run([
-                        opt,
-                        loss,
-                        acc,
-                        train_output,
-                        learning_rate,
-                        global_step,
-                        ], feed_dict=feed_dict)
-
-                    # del input_data, gt_data, cbcr_data
-
-                print output.shape
+                results = sess.run(fetches, feed_dict=feed_dict,
+                                   **profiler.run_kwargs(micro_step))
+                step_timer.mark('run')
+                if profiler.active(micro_step):
+                    profiler.record(micro_step)
+                    step_timer.mark('profile')
+                if data_parallel is not None:
+                    data_parallel.step(sess, results[0])
+                    step_timer.mark('allreduce')
+                g_step = results[2]
+                if preview:
+                    (output, lr) = results[3:5]
+                if len(results) > 5:
+                    (input_data, gt_data) = results[5:]
+                if LOG_EVERY and (step + 1) % LOG_EVERY == 0:
+                    print '[step %d] loss %.4f\t acc %.4f' % ((g_step, )
+                            + tuple(sess.run([mean_loss, mean_acc])))
+                if evaluator is not None and train_op is opt \
+                    and evaluator.maybe_submit(sess, g_step):
+                    step_timer.mark('snapshot')
+                if state_writer is not None and STATE_EVERY and (step
+                        + 1) % STATE_EVERY == 0 and step + 1 < steps:
+                    state_writer.submit(sess, g_step,
+                            extra=training_state(epoch, step + 1))
+                    step_timer.mark('state')
+
+                # del input_data, gt_data, cbcr_data
+
+            # previews, checkpoints and tests are left to worker 0
+
+            if not is_chief:
+
+                # follow the schedule and early stopping of worker 0
+
+                psnr_vdsr = ring.broadcast_scalar(0.0)
+                lr_schedule.update(psnr_vdsr)
+                if early_stopping.update(epoch, psnr_vdsr, time.time()
+                        - epoch_start, cpu_seconds() - epoch_cpu):
+                    break
+                continue
+
+            print output.shape
+            with step_timer.phase('preview'):
                 img = util.combine_img_prediction(input_data, gt_data,
                         output)
                 name = 'epoch_%s' % epoch
                 util.save_image(img, '%s/%s.jpg' % (prediction_path,
                                 name))
-                print '[epoch %2.4f] loss %.4f\t acc %.4f\t lr %.7f' \
-                    % (epoch + float(step) * BATCH_SIZE
-                       / len(train_list), np.sum(l), accuracy, lr)
-                psnr_bicub = psnr(input_data, gt_data, 0)
-                psnr_vdsr = psnr(output, gt_data, 0)
-                print 'PSNR: bicubic %f\U-NET %f' % (psnr_bicub,
-                        psnr_vdsr)
-
-                # print "[epoch %2.4f] loss %.4f\t lr %.7f"%(epoch+(float(step)*BATCH_SIZE/len(train_list)), np.sum(l)/BATCH_SIZE, lr)
-
-                # saver.save(sess, "./checkpoints/VDSR_const_clip_0.01_epoch_%03d.ckpt" % epoch ,global_step=global_step)
-
-                saver.save(sess, ckpt_path)
-
-                # test_VDSR(epoch, ckpt_path, TEST_DATA_PATH)
-
-                img_list = get_train_list(TEST_DATA_PATH)
-
-                # print img_list
-
-                (input_list, gt_list, scale_list) = \
-                    get_test_image(img_list, 0, 10)
-                start_t = time.time()
-
-                feed_dict = {test_input: input_list, train_gt: gt_data,
-                             train_input: input_data}
-
-                (
-                    _,
-                    l,
-                    accuracy,
-                    output,
-                    lr,
-                    g_step,
-                    ) = sess.run([
-                    opt,
-                    loss,
-                    acc,
-                    test_output,
-                    learning_rate,
-                    global_step,
-                    ], feed_dict=feed_dict)
-                print 'test_output', output.shape
-                end_t = time.time()
-                print 'end_t', end_t, 'start_t', start_t
-                print 'time consumption', end_t - start_t
+            (l, accuracy) = sess.run([mean_loss, mean_acc])
+            print '[epoch %2.4f] loss %.4f\t acc %.4f\t lr %.7f' \
+                % (epoch + float(step + 1) / steps, l, accuracy, lr)
+            psnr_bicub = psnr(input_data, gt_data, 0)
+            psnr_vdsr = psnr(output, gt_data, 0)
+            print 'PSNR: bicubic %f\U-NET %f' % (psnr_bicub,
+                    psnr_vdsr)
+            print 'train throughput: %.1f samples/sec' % ((steps
+                    - first_step)
+                    * BATCH_SIZE / (time.time() - epoch_start))
+            if prefetcher is not None:
+                print 'data wait per step: mean %.4fs\t max %.4fs\t total %.1fs' \
+                    % prefetcher.pop_wait_stats()
+
+            # print "[epoch %2.4f] loss %.4f\t lr %.7f"%(epoch+(float(step)*BATCH_SIZE/len(train_list)), np.sum(l)/BATCH_SIZE, lr)
+
+            # saver.save(sess, "./checkpoints/VDSR_const_clip_0.01_epoch_%03d.ckpt" % epoch ,global_step=global_step)
+
+            # test_VDSR(epoch, ckpt_path, TEST_DATA_PATH)
+
+            start_t = time.time()
+
+            # inference only: no optimizer step and no training batch. The
+            # slices of each size run as one batch, the first is previewed
+
+            with step_timer.phase('test'):
+                (test_l, psnr_vdsr, outputs) = run_eval(
+                    sess,
+                    eval_set,
+                    test_input,
+                    test_gt,
+                    test_loss,
+                    test_psnr,
+                    test_prediction,
+                    )
+            (input_list, gt_list) = eval_set.groups[0]
+            output = outputs[0]
+            print 'test_output', output.shape
+            end_t = time.time()
+            print 'end_t', end_t, 'start_t', start_t
+            print 'time consumption', end_t - start_t
+            with step_timer.phase('preview'):
                 img = util.combine_img_prediction(input_list, gt_list,
                         output)
                 name = 'test_epoch_%s' % epoch
                 util.save_image(img, '%s/%s.jpg' % (prediction_path,
                                 name))
-                print '[test epoch %2.4f] loss %.4f\t acc %.4f\t lr %.7f' \
-                    % (epoch + float(step) * BATCH_SIZE
-                       / len(train_list), np.sum(l), accuracy, lr)
-                psnr_bicub = psnr(input_list, gt_list, 0)
-                psnr_vdsr = psnr(output, gt_list, 0)
-                print 'test PSNR: bicubic %f\U-NET %f' % (psnr_bicub,
-                        psnr_vdsr)
+            print '[test epoch %2.4f] loss %.4f' % (epoch + float(step + 1)
+                    / steps, test_l)
+            psnr_bicub = eval_set.baseline_psnr
+            print 'test PSNR: bicubic %f\U-NET %f' % (psnr_bicub,
+                    psnr_vdsr)
+            if ring is not None:
+                ring.broadcast_scalar(psnr_vdsr)
+            lr_schedule.update(psnr_vdsr)
+            stop = early_stopping.update(epoch, psnr_vdsr, time.time()
+                    - epoch_start, cpu_seconds() - epoch_cpu)
+
+            # only the variable copies are timed, the files are written on
+            # the checkpoint threads
+
+            with step_timer.phase('save'):
+                checkpoints.submit(sess, g_step, psnr=psnr_vdsr)
+                state_writer.submit(sess, g_step,
+                                    extra=training_state(epoch + 1, 0))
+            step_timer.log_epoch(epoch)
+            if stop:
+                print early_stopping.report(epoch, MAX_EPOCH)
+                break
+        if prefetcher is not None:
+            prefetcher.close()
+        if evaluator is not None:
+            evaluator.close()
+        if checkpoints is not None:
+            checkpoints.close()
+        if state_writer is not None:
+            state_writer.close()
+        if ring is not None:
+            ring.close()
@@ -137,6 +137,7 @@ def unet(
     filter_size=3,
     pool_size=2,
     summaries=False,
+    device='/gpu:0',
     ):
     """
     Creates a new convolutional unet for the given parametrization.
@@ -150,9 +151,11 @@ def unet(
     :param filter_size: size of the convolution filter
     :param pool_size: size of the max pooling operation
     :param summaries: Flag if summaries should be created
+    :param device: device to build the network on, None leaves placement to
+        the session
     """
 
-    with tf.device('/gpu:0'):
+    with tf.device(device):
         logging.info('Layers {layers}, features {features}, filter size {filter_size}x{filter_size}, pool size: {pool_size}x{pool_size}'.format(layers=layers,
                      features=features_root, filter_size=filter_size,
                      pool_size=pool_size))
@@ -336,8 +339,8 @@ def unet(
 
             return (output_map, variables)
 
-def model(input_tensor):
-	with tf.device("/gpu:0"):
+def model(input_tensor, device="/gpu:0"):
+	with tf.device(device):
 		weights = []
 		tensor = None
 
@@ -508,11 +511,14 @@ class Unet(object):
     :param n_class: (optional) number of output labels
     :param cost: (optional) name of the cost function. Default is 'cross_entropy'
     :param cost_kwargs: (optional) kwargs passed to the cost function. See Unet._get_cost for more options
+    :param config: (optional) tf.ConfigProto of the sessions, e.g. from SESSION.session_config
     """
 
-    def __init__(self, channels=3, n_class=2, cost="cross_entropy", cost_kwargs={}, **kwargs):
+    def __init__(self, channels=3, n_class=2, cost="cross_entropy", cost_kwargs={}, config=None, **kwargs):
         tf.reset_default_graph()
 
+        self.config = config
+
         self.n_class = n_class
         self.summaries = kwargs.get("summaries", False)
         self.global_step = tf.Variable(0, trainable=False)
@@ -544,7 +550,7 @@ class Unet(object):
         """
 
         init = tf.global_variables_initializer()
-        with tf.Session() as sess:
+        with tf.Session(config=self.config) as sess:
             # Initialize variables
             sess.run(init)
 
@@ -651,7 +657,7 @@ class Trainer(object):
 
         init = self._initialize(training_iters, output_path, restore)
 
-        with tf.Session() as sess:
+        with tf.Session(config=self.net.config) as sess:
             sess.run(init)
 
             if restore: